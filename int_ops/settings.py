@@ -119,3 +119,132 @@ USE_TZ = False
 # https://docs.djangoproject.com/en/2.0/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Scheduler job store
+# Format of DjangoJob.job_state: pickle, zlib, lz4 or msgpack (see jobs.serializers)
+
+JOBS_JOB_STATE_FORMAT = 'pickle'
+
+# The scheduler runs in its own process (manage.py runscheduler) and is woken up
+# by datagrams on this address when other processes change jobs (on PostgreSQL
+# by LISTEN/NOTIFY instead, see jobs.control.notify). Datagrams go to this one
+# address only: scheduler nodes on other hosts never receive them and fall back
+# to JOBS_JOB_LEASE['sync_interval']
+
+JOBS_SCHEDULER_CONTROL = ('127.0.0.1', 47901)
+
+# Set lease_seconds when several runscheduler nodes share the database, so that
+# every due job is claimed and executed by one node only. Without PostgreSQL the
+# nodes then also read the job table every sync_interval seconds, see above
+
+JOBS_JOB_LEASE = {
+    'lease_seconds': None,
+    'node_id': None,
+    'sync_interval': 10,
+}
+
+
+# Scheduler job results
+# Events are buffered and written in batches, see jobs.result_storage.BufferedResultStorage;
+# batches that fail are retried up to max_attempts times
+
+JOBS_RESULT_BUFFER = {
+    'flush_interval': 1.0,
+    'batch_size': 500,
+    'max_attempts': 30,
+    'open_timeout': 86400,
+}
+
+
+# Executions older than keep_days are archived or deleted (see jobs.retention) daily
+# at 'cron', unless a RetentionPolicy set in the admin says otherwise
+
+JOBS_EXECUTION_RETENTION = {
+    'keep_days': 90,
+    'action': 'archive',
+    'batch_size': 1000,
+    'cron': {'hour': 3, 'minute': 30},
+}
+
+
+# Report exports
+# Files larger than an EmailJob's attachment limit are linked in the email as
+# JOBS_EXPORT_BASE_URL + JOBS_EXPORT_URL + path, with a token valid for
+# JOBS_EXPORT_LINK_MAX_AGE seconds so recipients don't need an account
+
+JOBS_EXPORT_ROOT = os.path.join(BASE_DIR, 'exports')
+
+JOBS_EXPORT_BASE_URL = 'http://localhost:8000'
+
+JOBS_EXPORT_URL = '/exports/'
+
+JOBS_EXPORT_LINK_MAX_AGE = 7 * 24 * 3600
+
+# Exports reused by jobs running the same script, see EmailJob.cache_ttl; least
+# recently used entries are evicted when the cache outgrows JOBS_RESULT_CACHE_MAX_SIZE MB
+
+JOBS_RESULT_CACHE_ROOT = os.path.join(BASE_DIR, 'exports_cache')
+
+JOBS_RESULT_CACHE_MAX_SIZE = 1024
+
+
+# Pools of connections to the EmailJob.conn_str databases, see jobs.db_pool
+
+JOBS_DB_POOL = {
+    'max_size': 5,
+    'idle_timeout': 300,
+    'check_after': 30,
+    'wait_timeout': 60,
+}
+
+
+# Admission of export runs to their target database, see jobs.admission.AdmissionControl;
+# runs more than 'late_after' seconds late wait a random 0 to 'max_jitter' seconds first
+
+JOBS_ADMISSION = {
+    'max_runs_per_target': 2,
+    'late_after': 60,
+    'max_jitter': 300,
+}
+
+
+# Worker processes writing the exports of EmailJobs with render_process set, see
+# jobs.render.RenderPool; memory_limit is in MB per worker, 0 means no limit
+
+JOBS_RENDER = {
+    'processes': 2,
+    'max_tasks_per_child': 20,
+    'memory_limit': 1024,
+}
+
+
+# Export run metrics (see jobs.metrics), served by the scheduler process on 'address'
+# and exposed at /metrics to staff and to scrapers sending 'token' as a Bearer token.
+# 'allowed_ips' are let in by REMOTE_ADDR; behind a reverse proxy that is the proxy's
+# address for every request, so leave it empty there
+
+JOBS_METRICS = {
+    'address': ('127.0.0.1', 47902),
+    'token': None,
+    'allowed_ips': (),
+}
+
+
+# Report email delivery, see jobs.mail
+
+JOBS_MAIL = {
+    'workers': 2,
+    'idle_timeout': 60,
+    'max_idle': 2,
+}
+
+
+# The asyncio execution mode (runscheduler --asyncio), see jobs.pipeline.ExportPipeline
+
+JOBS_ASYNC = {
+    'fetch_threads': 32,
+    'write_threads': 4,
+    'queue_size': 4,
+    'max_runs': 500,
+}
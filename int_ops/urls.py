@@ -16,6 +16,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 
+from jobs import views as jobs_views
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('exports/<path:path>', jobs_views.export_file, name='export_file'),
+    path('metrics', jobs_views.metrics, name='metrics'),
+    path('forecast', jobs_views.forecast, name='forecast'),
 ]
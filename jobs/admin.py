@@ -1,14 +1,18 @@
 import os
-import json
 import datetime
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.db import models
 from django import forms
+from django.template.response import TemplateResponse
+from django.urls import path
 # Register your models here.
-from .models import EmailJob, ScriptFile, DjangoJob, DjangoJobExecution
-from django.db.models import Avg
+from .models import EmailJob, ScriptFile, DjangoJob, DjangoJobExecution, RetentionPolicy
+from .stats import JobStats, job_stats
 from django.utils.timezone import now
-from .jobs import scheduler, exp_oracle_script_job
+from .control import JobControl, shared_control
+from .forecast import hot_minutes
+from .jobs import exp_oracle_script_job
+from .util import int_param
 
 
 
@@ -20,7 +24,7 @@ class EmailJobForm(forms.ModelForm):
 
     class Meta:
         model = EmailJob
-        exclude = ['created_date', 'trigger_type', 'user']
+        exclude = ['created_date', 'user']
         widgets = {
             'sender_pass' : forms.PasswordInput()
         }
@@ -45,7 +49,7 @@ class EmailJobAdmin(admin.ModelAdmin):
     form = EmailJobForm
 
     inlines = (ScriptInline,)
-    actions = ('start_job',)
+    actions = ('start_job', 'pause_job', 'resume_job', 'stop_job')
 
 
     def save_model(self, request, obj, form, change):
@@ -53,18 +57,41 @@ class EmailJobAdmin(admin.ModelAdmin):
         super().save_model(request, obj, form, change)
 
     def start_job(self, request, queryset):
+        control = JobControl()
+        jobs = []
         for obj in queryset:
-            kwargs = json.loads(obj.trigger_value)
-            scheduler.add_job(exp_oracle_script_job, 
-                                'cron', 
-                                id=obj.name,
-                                args=(obj,),
-                                **kwargs
-                                )
-
+            try:
+                jobs.append(control.build_job(exp_oracle_script_job,
+                                              obj.get_trigger(control.scheduler.timezone),
+                                              id=obj.name,
+                                              args=(obj.pk,),
+                                              misfire_grace_time=obj.misfire_grace_time or None,
+                                              coalesce=obj.coalesce,
+                                              max_instances=max(obj.max_instances, 1),
+                                              ))
+            except ValueError as e:
+                self.message_user(request, '任务 %s 的触发参数无效: %s' % (obj.name, e), messages.ERROR)
+        # Already scheduled jobs are replaced, all in one transaction
+        control.add_jobs(jobs, replace_existing=True)
+        self.message_user(request, '已启动 %d 个任务' % len(jobs))
 
     start_job.short_description = '启动任务'
 
+    def pause_job(self, request, queryset):
+        paused = JobControl().pause_jobs([obj.name for obj in queryset])
+        self.message_user(request, '已暂停 %d 个任务' % len(paused))
+    pause_job.short_description = '暂停任务'
+
+    def resume_job(self, request, queryset):
+        resumed = JobControl().resume_jobs([obj.name for obj in queryset])
+        self.message_user(request, '已恢复 %d 个任务' % len(resumed))
+    resume_job.short_description = '恢复任务'
+
+    def stop_job(self, request, queryset):
+        removed = JobControl().remove_jobs([obj.name for obj in queryset])
+        self.message_user(request, '已停止 %d 个任务' % removed)
+    stop_job.short_description = '停止任务'
+
     formfield_overrides = {
         models.CharField: {'widget': forms.TextInput(attrs={'size': '100'})},
     }
@@ -72,26 +99,79 @@ class EmailJobAdmin(admin.ModelAdmin):
 
 @admin.register(DjangoJob)
 class DjangoJobAdmin(admin.ModelAdmin):
-    list_display = ["id", "name", "next_run_time_sec", "average_duration"]
+    list_display = ["id", "name", "next_run_time_sec", "run_count", "error_count",
+                    "average_duration", "p50_duration", "p95_duration", "max_duration"]
     actions = []
+    change_list_template = 'admin/jobs/djangojob/change_list.html'
+
+    def get_urls(self):
+        return [
+            path('forecast/', self.admin_site.admin_view(self.forecast_view), name='jobs_djangojob_forecast'),
+        ] + super().get_urls()
+
+    def forecast_view(self, request):
+        """
+        Next fire times of every scheduled job, and the minutes in which most jobs fire
+        with their expected load (sum of the jobs' average durations).
+        """
+        days = int_param(request, 'days', 7, 31)
+        limit = int_param(request, 'limit', 10, 100)
+        fire_times = shared_control().forecast(days)
+        pks = dict(DjangoJob.objects.values_list('name', 'id'))
+        stats = job_stats(now() - datetime.timedelta(days=2))
+
+        def load(job_ids):
+            return round(sum((stats.get(pks.get(job_id)) or JobStats()).avg_duration for job_id in job_ids), 2)
+
+        context = dict(
+            self.admin_site.each_context(request),
+            title='触发时间预测',
+            opts=self.model._meta,
+            days=days,
+            limit=limit,
+            hot_minutes=[(minute, len(job_ids), load(job_ids), sorted(job_ids))
+                         for minute, job_ids in hot_minutes(fire_times)],
+            jobs=sorted((job_id, times[:limit]) for job_id, times in fire_times.items()),
+        )
+        return TemplateResponse(request, 'admin/jobs/djangojob/forecast.html', context)
 
     def get_queryset(self, request):
-        self._durations = {
-            item[0]: item[1]
-            for item in DjangoJobExecution.objects.filter(
-                status=DjangoJobExecution.SUCCESS,
-                run_time__gte=now() - datetime.timedelta(days=2)
-            ).values_list('job').annotate(duration=Avg('duration'))
-        }
+        # Read from the hourly rollup instead of aggregating DjangoJobExecution
+        self._stats = job_stats(now() - datetime.timedelta(days=2))
         return super().get_queryset(request)
 
     def next_run_time_sec(self, obj):
+        if obj.next_run_time is None:
+            return '暂停'
         return obj.next_run_time.strftime('%Y-%m-%d %H:%M:%S')
     next_run_time_sec.short_description = '下次执行'
 
+    def _job_stats(self, obj):
+        return self._stats.get(obj.id) or JobStats()
+
+    def run_count(self, obj):
+        return self._job_stats(obj).count
+    run_count.short_description = '两日内执行次数'
+
+    def error_count(self, obj):
+        return self._job_stats(obj).error_count
+    error_count.short_description = '两日内失败次数'
+
     def average_duration(self, obj):
-        return self._durations.get(obj.id) or 0
-    average_duration.short_description = '两日内平均执行时长(S)'    
+        return round(self._job_stats(obj).avg_duration, 2)
+    average_duration.short_description = '两日内平均执行时长(S)'
+
+    def p50_duration(self, obj):
+        return round(self._job_stats(obj).percentile(50), 2)
+    p50_duration.short_description = '两日内P50执行时长(S)'
+
+    def p95_duration(self, obj):
+        return round(self._job_stats(obj).percentile(95), 2)
+    p95_duration.short_description = '两日内P95执行时长(S)'
+
+    def max_duration(self, obj):
+        return round(self._job_stats(obj).max_duration, 2)
+    max_duration.short_description = '两日内最大执行时长(S)'
 
 
 
@@ -111,5 +191,8 @@ class DjangoJobExecutionAdmin(admin.ModelAdmin):
         return super(DjangoJobExecutionAdmin, self).get_queryset(
             request
         ).select_related("job")
- 
-    
\ No newline at end of file
+
+
+@admin.register(RetentionPolicy)
+class RetentionPolicyAdmin(admin.ModelAdmin):
+    list_display = ["job", "status", "keep_days", "action"]
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import time
+import random
+import asyncio
+import logging
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from threading import BoundedSemaphore, Lock
+
+from apscheduler.executors.base import run_job
+from apscheduler.executors.pool import ThreadPoolExecutor
+from django.conf import settings
+
+LOGGER = logging.getLogger("jobs.admission")
+
+# Scheduled run time of the job running in the current thread or task, set by the executors
+scheduled_time = ContextVar('scheduled_time', default=None)
+
+
+class AdmissionControl(object):
+    """
+    Admits export runs to their target database: at most ``max_runs_per_target``
+    runs query one conn_str at a time, the others wait for a slot. Runs starting
+    more than ``late_after`` seconds after their scheduled time are catch-up runs
+    (the scheduler was down or busy) and first wait a random 0 to ``max_jitter``
+    seconds, so a restart doesn't send them all to the database at once.
+    :param int max_runs_per_target: runs per conn_str, 0 means no limit
+    :param int late_after: seconds of delay that make a run a catch-up run
+    :param int max_jitter: upper bound of the catch-up delay in seconds
+    """
+
+    def __init__(self, max_runs_per_target=2, late_after=60, max_jitter=300):
+        self.max_runs_per_target = max_runs_per_target
+        self.late_after = late_after
+        self.max_jitter = max_jitter
+        self._slots = {}
+        self._async_slots = {}
+        self._lock = Lock()
+
+    def jitter(self, now=None):
+        """
+        :return: seconds the current run waits before it asks for a slot
+        """
+        run_time = scheduled_time.get()
+        if run_time is None or not self.max_jitter:
+            return 0
+        now = now or datetime.now(run_time.tzinfo)
+        if (now - run_time).total_seconds() <= self.late_after:
+            return 0
+        return random.uniform(0, self.max_jitter)
+
+    @contextmanager
+    def admit(self, target):
+        """
+        Holds a slot of ``target`` (a conn_str) for the duration of the block.
+        """
+        delay = self.jitter()
+        if delay:
+            LOGGER.info('Catch-up run on %s delayed by %.0fs', _host(target), delay)
+            time.sleep(delay)
+        if not self.max_runs_per_target:
+            yield
+            return
+        with self._lock:
+            slots = self._slots.get(target)
+            if slots is None:
+                slots = self._slots[target] = BoundedSemaphore(self.max_runs_per_target)
+        with slots:
+            yield
+
+    @asynccontextmanager
+    async def admit_async(self, target):
+        """
+        ``admit`` for coroutines. Their slots are shared by the coroutines of one
+        event loop, not with threads.
+        """
+        delay = self.jitter()
+        if delay:
+            LOGGER.info('Catch-up run on %s delayed by %.0fs', _host(target), delay)
+            await asyncio.sleep(delay)
+        if not self.max_runs_per_target:
+            yield
+            return
+        slots = self._async_slots.get(target)
+        if slots is None:
+            slots = self._async_slots[target] = asyncio.BoundedSemaphore(self.max_runs_per_target)
+        async with slots:
+            yield
+
+
+def _host(conn_str):
+    # Keeps passwords out of the log
+    return conn_str.rsplit('@', 1)[-1]
+
+
+admission = AdmissionControl(**settings.JOBS_ADMISSION)
+
+
+def _run_job(job, jobstore_alias, run_times, logger_name):
+    scheduled_time.set(run_times[0])
+    return run_job(job, jobstore_alias, run_times, logger_name)
+
+
+class AdmissionThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    The scheduler's thread pool executor, jobs can read their scheduled run time
+    from ``scheduled_time``.
+    """
+
+    def _do_submit_job(self, job, run_times):
+        def callback(f):
+            exc = f.exception()
+            if exc:
+                self._run_job_error(job.id, exc, exc.__traceback__)
+            else:
+                self._run_job_success(job.id, f.result())
+
+        f = self._pool.submit(_run_job, job, job._jobstore_alias, run_times, self._logger.name)
+        f.add_done_callback(callback)
@@ -0,0 +1,133 @@
+"""
+Micro benchmarks for the scheduler pipeline, run them with
+``python manage.py benchmark <name>``.
+
+Benchmarks that return a list of ``Measurement`` get ops/s, latency percentiles and
+peak traced memory reported, and compared against a stored baseline when one exists
+(``--save-baseline`` records the current run). Memory is traced with tracemalloc
+while timing, which slows allocation heavy code down severalfold; ``--no-memory``
+turns tracing off for throughput numbers. Compare runs, not machines.
+"""
+import json
+import os
+import time
+import tracemalloc
+
+# Set by the benchmark command
+TRACE_MEMORY = True
+
+
+def timed(func, number):
+    """
+    Calls ``func`` ``number`` times.
+    :return: seconds per call
+    """
+    started = time.perf_counter()
+    for _ in range(number):
+        func()
+    return (time.perf_counter() - started) / number
+
+
+class Measurement(object):
+    """
+    :param str name: what was measured, unique within a benchmark module
+    :param int ops: operations performed
+    :param float seconds: total wall time
+    :param list latencies: seconds of each call
+    :param int peak_memory: peak traced bytes allocated during the measurement
+    """
+
+    def __init__(self, name, ops, seconds, latencies=(), peak_memory=0):
+        self.name = name
+        self.ops = ops
+        self.seconds = seconds
+        self.latencies = sorted(latencies)
+        self.peak_memory = peak_memory
+
+    @property
+    def ops_per_sec(self):
+        return self.ops / self.seconds if self.seconds else 0
+
+    def percentile(self, p):
+        if not self.latencies:
+            return 0
+        return self.latencies[min(int(len(self.latencies) * p / 100), len(self.latencies) - 1)]
+
+    def as_dict(self):
+        return {
+            'ops': self.ops,
+            'ops_per_sec': self.ops_per_sec,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'peak_memory': self.peak_memory,
+        }
+
+
+def measure(name, func, number, ops_per_call=1):
+    """
+    Calls ``func(i)`` for i in range(number), timing every call.
+    :param int ops_per_call: operations one call stands for, e.g. jobs handled per poll
+    :return: Measurement
+    """
+    latencies = []
+    peak_memory = 0
+    if TRACE_MEMORY:
+        tracemalloc.start()
+    try:
+        started = time.perf_counter()
+        for i in range(number):
+            call_started = time.perf_counter()
+            func(i)
+            latencies.append(time.perf_counter() - call_started)
+        seconds = time.perf_counter() - started
+        if TRACE_MEMORY:
+            peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        if TRACE_MEMORY:
+            tracemalloc.stop()
+    return Measurement(name, number * ops_per_call, seconds, latencies, peak_memory)
+
+
+def report(stdout, benchmark, measurements, baseline=None):
+    """
+    Writes one line per measurement, with the change against ``baseline``
+    (the dict stored by ``save_baseline``) when it has the same measurement.
+    """
+    baseline = (baseline or {}).get(benchmark, {})
+    stdout.write('%-36s %10s %12s %10s %10s %10s %10s  %s' % (
+        'measurement', 'ops', 'ops/s', 'p50 ms', 'p95 ms', 'p99 ms', 'peak MiB', 'vs baseline'))
+    for m in measurements:
+        line = '%-36s %10d %12.0f %10.3f %10.3f %10.3f %10.1f' % (
+            m.name, m.ops, m.ops_per_sec, m.percentile(50) * 1e3, m.percentile(95) * 1e3,
+            m.percentile(99) * 1e3, m.peak_memory / 1048576.0)
+        base = baseline.get(m.name)
+        if base:
+            line += '  ops/s %s, p95 %s, memory %s' % (
+                _change(m.ops_per_sec, base['ops_per_sec']),
+                _change(m.percentile(95), base['p95']),
+                _change(m.peak_memory, base['peak_memory']))
+        stdout.write(line)
+
+
+def _change(value, base):
+    if not base:
+        return 'n/a'
+    return '%+.1f%%' % ((value - base) * 100.0 / base)
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def save_baseline(path, benchmark, measurements):
+    """
+    Stores the measurements of ``benchmark``, keeping those of other benchmarks.
+    """
+    baseline = load_baseline(path)
+    baseline[benchmark] = {m.name: m.as_dict() for m in measurements}
+    with open(path, 'w') as fp:
+        json.dump(baseline, fp, indent=2, sort_keys=True)
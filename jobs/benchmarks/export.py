@@ -0,0 +1,118 @@
+"""
+exp_oracle_script_job end to end: a synthetic SQLite table of ``--rows`` rows is
+exported and mailed to an SMTP stand-in listening on localhost. A run is timed
+until the mail queue has delivered the message.
+"""
+import os
+import shutil
+import smtplib
+import socketserver
+import sqlite3
+import tempfile
+from threading import Thread
+
+from django.contrib.auth.models import User
+from django.test import override_settings
+
+import jobs.jobs
+from jobs.mail import MailQueue, SMTPConnectionPool
+from jobs.models import EmailJob, ScriptFile
+from . import measure
+
+RUNS = 3
+# (export format, render in a worker process)
+CASES = (('csv', False), ('xlsx', False), ('xlsx', True))
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Accepts every command and discards the message data.
+    """
+
+    def handle(self):
+        self.wfile.write(b'220 benchmark\r\n')
+        for line in self.rfile:
+            command = line[:4].upper()
+            if command in (b'EHLO', b'HELO'):
+                self.wfile.write(b'250 benchmark\r\n')
+            elif command == b'DATA':
+                self.wfile.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+                size = 0
+                for data in self.rfile:
+                    if data == b'.\r\n':
+                        break
+                    size += len(data)
+                self.server.received.append(size)
+                self.wfile.write(b'250 OK\r\n')
+            elif command == b'QUIT':
+                self.wfile.write(b'221 Bye\r\n')
+                break
+            else:
+                self.wfile.write(b'250 OK\r\n')
+
+
+class _PlainSMTPConnectionPool(SMTPConnectionPool):
+    # The stand-in speaks plain SMTP without authentication
+    def _connect(self, server, port, sender, password):
+        return smtplib.SMTP(server, port)
+
+
+def _create_table(path, rows):
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE report (id INTEGER, name TEXT, amount NUMERIC, ratio REAL, created TEXT, note TEXT)')
+    conn.executemany('INSERT INTO report VALUES (?, ?, ?, ?, ?, ?)', (
+        (i, 'customer %d' % i, i / 100.0, i / 7.0, '2020-01-01 00:%02d:%02d' % (i // 60 % 60, i % 60),
+         None if i % 3 else 'note')
+        for i in range(rows)
+    ))
+    conn.commit()
+    conn.close()
+
+
+def run(stdout, rows=1000000, **options):
+    tmp = tempfile.mkdtemp(prefix='export-benchmark-')
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), _SMTPHandler)
+    server.daemon_threads = True
+    server.received = []
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    mail_queue = jobs.jobs.mail_queue
+    jobs.jobs.mail_queue = MailQueue(1, _PlainSMTPConnectionPool())
+    user, _ = User.objects.get_or_create(username='benchmark')
+    measurements = []
+    try:
+        db = os.path.join(tmp, 'report.db')
+        _create_table(db, rows)
+        script = os.path.join(tmp, 'report.sql')
+        with open(script, 'w') as fp:
+            fp.write('SELECT * FROM report')
+
+        for export_format, render_process in CASES:
+            name = export_format + (' process' if render_process else '')
+            email_job = EmailJob.objects.create(
+                name='benchmark-export', trigger_type='cron', conn_str='sqlite:///%s' % db,
+                export_format=export_format, render_process=render_process,
+                smtp_server='127.0.0.1', smtp_port=server.server_address[1],
+                sender='benchmark@localhost', sender_pass='-', subject='benchmark',
+                to_email='benchmark@localhost', user=user)
+            ScriptFile.objects.create(script_file=script, email_job=email_job)
+
+            def export(i):
+                jobs.jobs.exp_oracle_script_job(email_job.pk)
+                # Waits for the queued message to be delivered
+                jobs.jobs.mail_queue.close()
+
+            with override_settings(JOBS_EXPORT_ROOT=os.path.join(tmp, 'exports')):
+                measurements.append(measure('exp_oracle_script_job %s' % name, export, RUNS,
+                                            ops_per_call=rows))
+            email_job.delete()
+            stdout.write('%s: %d rows, %d bytes of message data per run' % (
+                name, rows, server.received[-1] if server.received else 0))
+    finally:
+        jobs.jobs.mail_queue.close()
+        jobs.jobs.mail_queue = mail_queue
+        server.shutdown()
+        server.server_close()
+        EmailJob.objects.filter(name='benchmark-export').delete()
+        shutil.rmtree(tmp, ignore_errors=True)
+    return measurements
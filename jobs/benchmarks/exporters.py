@@ -0,0 +1,58 @@
+"""
+Rows per second of every export format on a synthetic result set.
+"""
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from jobs.exporters import WRITERS, export_cursor
+from . import measure
+
+
+class SyntheticCursor(object):
+    """
+    DB-API cursor stand-in returning ``rows`` rows of typical report columns.
+    """
+    description = [('ID',), ('NAME',), ('AMOUNT',), ('RATIO',), ('CREATED',), ('NOTE',)]
+
+    def __init__(self, rows):
+        self.remaining = rows
+        self.offset = 0
+        self.base = datetime(2020, 1, 1)
+
+    def fetchmany(self, size):
+        size = min(size, self.remaining)
+        start = self.offset
+        rows = [(i, 'customer %d' % i, Decimal(i) / 100, i / 7.0,
+                 self.base + timedelta(seconds=i), None if i % 3 else 'note')
+                for i in range(start, start + size)]
+        self.offset += size
+        self.remaining -= size
+        return rows
+
+
+def run(stdout, rows=1000000, **options):
+    tmp = tempfile.mkdtemp(prefix='export-benchmark-')
+    measurements = []
+    try:
+        for export_format in WRITERS:
+            # xls keeps the workbook in memory and tops out at 65535 rows per sheet
+            _rows = min(rows, 100000) if export_format == 'xls' else rows
+            path_base = os.path.join(tmp, export_format.replace('.', '_'))
+            paths = []
+            try:
+                measurement = measure(export_format,
+                                      lambda i: paths.extend(export_cursor(SyntheticCursor(_rows), path_base,
+                                                                           export_format)[0]),
+                                      1, ops_per_call=_rows)
+            except RuntimeError as e:
+                stdout.write('%-8s skipped: %s' % (export_format, e))
+                continue
+            measurements.append(measurement)
+            stdout.write('%-8s %d rows, %d bytes' % (export_format, _rows,
+                                                     sum(os.path.getsize(path) for path in paths)))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return measurements
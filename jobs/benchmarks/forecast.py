@@ -0,0 +1,44 @@
+"""
+Fire times of 1k to 100k jobs (``--sizes``) over 7 days, as the forecast view computes
+them. Triggers are a mix of daily, weekday, monthly and interval schedules.
+"""
+from datetime import datetime, timedelta
+
+from apscheduler.schedulers.blocking import BlockingScheduler
+
+from jobs.forecast import FireCalendar, hot_minutes
+from jobs.triggers import compile_trigger
+from . import measure
+
+
+def _triggers(size, timezone):
+    values = []
+    for i in range(size):
+        kind = i % 4
+        if kind == 0:
+            values.append(('cron', '{"hour": %d, "minute": %d}' % (i % 24, i % 60)))
+        elif kind == 1:
+            values.append(('cron', '%d %d * * mon-fri' % (i % 60, i % 24)))
+        elif kind == 2:
+            values.append(('cron', '{"day": %d, "hour": %d, "minute": %d}' % (i % 28 + 1, i % 24, i % 60)))
+        else:
+            values.append(('interval', '{"minutes": %d}' % (30 + i % 90)))
+    return [compile_trigger(trigger_type, value, timezone) for trigger_type, value in values]
+
+
+def run(stdout, sizes=(1000, 10000, 100000), **options):
+    timezone = BlockingScheduler().timezone
+    start = datetime.now(timezone)
+    measurements = []
+    for size in sizes:
+        triggers = _triggers(size, timezone)
+
+        def fire_times(i):
+            calendar = FireCalendar(start, start + timedelta(days=7))
+            return {n: calendar.fire_times(trigger) for n, trigger in enumerate(triggers)}
+
+        measurements.append(measure('fire_times 7d %d' % size, fire_times, 1, size))
+        result = fire_times(0)
+        measurements.append(measure('hot_minutes %d' % size, lambda i: hot_minutes(result), 1, size))
+        stdout.write('%d jobs: %d fire times' % (size, sum(len(times) for times in result.values())))
+    return measurements
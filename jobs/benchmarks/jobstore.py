@@ -0,0 +1,83 @@
+"""
+DjangoJobStore add_job / update_job / get_due_jobs with 1k to 100k jobs (``--sizes``),
+and activating the same jobs with the bulk operations the admin actions use.
+Runs against the ``default`` database.
+"""
+from datetime import datetime, timedelta
+
+from apscheduler.job import Job
+from apscheduler.schedulers.blocking import BlockingScheduler
+from apscheduler.triggers.interval import IntervalTrigger
+from django.db import connections
+
+from jobs.jobstores import create_jobstore, job_pks
+from jobs.models import DjangoJob
+from . import measure
+
+
+def noop():
+    pass
+
+
+def _jobs(scheduler, size, now):
+    # Next run times spread over an hour, so about 1/60 of the jobs is due per minute
+    return [
+        Job(scheduler, id='benchmark-%d' % i, func='jobs.benchmarks.jobstore:noop',
+            trigger=IntervalTrigger(minutes=5 + i % 55, start_date=now, timezone=scheduler.timezone),
+            executor='default', args=(), kwargs={}, name='benchmark-%d' % i,
+            misfire_grace_time=1, coalesce=True, max_instances=1,
+            next_run_time=now + timedelta(seconds=i % 3600))
+        for i in range(size)
+    ]
+
+
+def _store(scheduler):
+    store = create_jobstore(lease_seconds=None, notify_changes=False)
+    store.start(scheduler, 'default')
+    return store
+
+
+def _reset():
+    DjangoJob.objects.filter(name__startswith='benchmark-').delete()
+    job_pks.clear()
+
+
+def run(stdout, sizes=(1000, 10000, 100000), number=2000, **options):
+    stdout.write('%s, %s jobs' % (connections['default'].vendor, ', '.join(str(size) for size in sizes)))
+    scheduler = BlockingScheduler()
+    now = datetime.now(scheduler.timezone)
+    due = now + timedelta(minutes=1)
+    measurements = []
+    try:
+        for size in sizes:
+            _reset()
+            jobs = _jobs(scheduler, size, now)
+            store = _store(scheduler)
+            measurements.append(measure('add_job %d' % size, lambda i: store.add_job(jobs[i]), size))
+
+            updates = min(size, number)
+            for job in jobs[:updates]:
+                job.next_run_time += timedelta(hours=1)
+            measurements.append(measure('update_job %d' % size, lambda i: store.update_job(jobs[i]), updates))
+
+            # A scheduler process starting up: the whole table is loaded once
+            store = _store(scheduler)
+            measurements.append(measure('get_due_jobs cold %d' % size, lambda i: store.get_due_jobs(due), 1))
+
+            # Steady polling, every poll checks the table for changes
+            def poll(i):
+                store.invalidate()
+                store.get_due_jobs(due)
+                store.get_next_run_time()
+            measurements.append(measure('get_due_jobs poll %d' % size, poll, min(number, 200)))
+
+            # Bulk operations, one call for all the jobs
+            measurements.append(measure('add_jobs replace %d' % size,
+                                        lambda i: store.add_jobs(jobs, replace_existing=True), 1, size))
+            measurements.append(measure('update_jobs %d' % size, lambda i: store.update_jobs(jobs), 1, size))
+            measurements.append(measure('remove_jobs %d' % size,
+                                        lambda i: store.remove_jobs([job.id for job in jobs]), 1, size))
+            measurements.append(measure('add_jobs %d' % size, lambda i: store.add_jobs(jobs), 1, size))
+    finally:
+        _reset()
+    return measurements
@@ -0,0 +1,61 @@
+"""
+Events per second through the event manager for each result storage.
+Runs against the ``default`` database, point it at PostgreSQL to compare backends.
+"""
+from datetime import datetime, timedelta
+
+from apscheduler.events import (EVENT_JOB_EXECUTED, EVENT_JOB_SUBMITTED, JobExecutionEvent,
+                                JobSubmissionEvent)
+from django.db import connections
+from django.utils.timezone import make_aware
+
+from jobs.jobstores import _EventManager, job_pks
+from jobs.models import DjangoJob, DjangoJobExecution
+from jobs.result_storage import BufferedResultStorage, DjangoResultStorage
+from . import measure
+
+JOBS = 50
+
+
+def _events(runs):
+    start = make_aware(datetime(2030, 1, 1))
+    for run in range(runs):
+        run_time = start + timedelta(minutes=run)
+        for i in range(JOBS):
+            job_id = 'benchmark-%d' % i
+            yield JobSubmissionEvent(EVENT_JOB_SUBMITTED, job_id, 'default', [run_time])
+            yield JobExecutionEvent(EVENT_JOB_EXECUTED, job_id, 'default', run_time)
+
+
+def _reset():
+    DjangoJob.objects.filter(name__startswith='benchmark-').delete()
+    job_pks.clear()
+    DjangoJob.objects.bulk_create([
+        DjangoJob(name='benchmark-%d' % i, next_run_time=datetime(2030, 1, 1), job_state=b'')
+        for i in range(JOBS)
+    ])
+
+
+def run(stdout, number=2000, **options):
+    runs = max(number // (2 * JOBS), 1)
+    stdout.write('%s, %d events' % (connections['default'].vendor, runs * JOBS * 2))
+    measurements = []
+    for storage_class in (DjangoResultStorage, BufferedResultStorage):
+        _reset()
+        storage = storage_class()
+        manager = _EventManager(storage)
+        events = list(_events(runs))
+
+        def handle(i):
+            manager(events[i])
+            if i == len(events) - 1:
+                # Buffered events count once they are written
+                storage.close()
+        measurements.append(measure(storage_class.__name__, handle, len(events)))
+
+        assert DjangoJobExecution.objects.filter(
+            job__name__startswith='benchmark-', finished__isnull=False
+        ).count() == runs * JOBS
+
+    DjangoJob.objects.filter(name__startswith='benchmark-').delete()
+    return measurements
@@ -0,0 +1,45 @@
+"""
+Bytes and (de)serialize time per job for every job_state format.
+"""
+from datetime import datetime
+
+from apscheduler.job import Job
+from apscheduler.schedulers.blocking import BlockingScheduler
+from apscheduler.triggers.cron import CronTrigger
+from django.contrib.auth.models import User
+
+from jobs.models import EmailJob
+from jobs.serializers import SERIALIZERS, load_job_state
+from . import timed
+
+
+def _job_state(args):
+    trigger = CronTrigger(day_of_week='mon-fri', hour=8, minute=30)
+    job = Job(BlockingScheduler(), id='daily-kpi', func='jobs.jobs:exp_oracle_script_job',
+              trigger=trigger, executor='default', args=args, kwargs={}, name='daily-kpi',
+              misfire_grace_time=1, coalesce=True, max_instances=1,
+              next_run_time=trigger.get_next_fire_time(None, datetime.now(trigger.timezone)))
+    return job.__getstate__()
+
+
+def run(stdout, number=2000, **options):
+    email_job = EmailJob(pk=1, name='daily-kpi', trigger_type='cron',
+                         trigger_value='{"day_of_week": "mon-fri", "hour": 8, "minute": 30}',
+                         conn_str='oracle://report:secret@db:1521/orcl', sender_pass='secret',
+                         subject='KPI', content='KPI report', to_email='ops@example.com',
+                         user=User(pk=1, username='admin'))
+    payloads = (('EmailJob instance', (email_job,)), ('EmailJob pk', (email_job.pk,)))
+
+    stdout.write('%-10s %-18s %10s %14s %14s' % ('format', 'args', 'bytes/job', 'dumps us/job', 'loads us/job'))
+    for name, serializer_class in SERIALIZERS.items():
+        try:
+            serializer = serializer_class()
+        except RuntimeError as e:
+            stdout.write('%-10s skipped: %s' % (name, e))
+            continue
+        for label, args in payloads:
+            state = _job_state(args)
+            data = serializer.dumps(state)
+            dumps = timed(lambda: serializer.dumps(state), number)
+            loads = timed(lambda: load_job_state(data), number)
+            stdout.write('%-10s %-18s %10d %14.1f %14.1f' % (name, label, len(data), dumps * 1e6, loads * 1e6))
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+import time
+import select
+import socket
+import logging
+from datetime import datetime
+from threading import Lock, Thread
+
+from apscheduler.job import Job
+from apscheduler.jobstores.base import ConflictingIdError, JobLookupError
+from apscheduler.schedulers.blocking import BlockingScheduler
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+LOGGER = logging.getLogger("jobs.control")
+
+WAKEUP = b'wakeup'
+# PostgreSQL NOTIFY channel of job store changes
+CHANNEL = 'jobs_changed'
+# Seconds between checks of the LISTEN connection / before reconnecting it
+LISTEN_TIMEOUT = 5
+LISTEN_RETRY = 5
+
+
+class JobControl(object):
+    """
+    Adds, modifies and triggers jobs from processes that don't run the scheduler
+    (web workers, management commands). Jobs are written to the job store directly,
+    which notifies the scheduler process of every change (see ``notify``).
+    :param jobstore: job store to write to, a new DjangoJobStore by default
+    """
+
+    def __init__(self, jobstore=None):
+        from .jobstores import create_jobstore
+
+        # Only used to build triggers and apply job defaults, never started
+        self.scheduler = BlockingScheduler()
+        self.jobstore = jobstore or create_jobstore()
+        self.jobstore.start(self.scheduler, 'default')
+        self._lock = Lock()
+
+    def add_job(self, func, trigger=None, args=None, kwargs=None, id=None, name=None,
+                replace_existing=False, **trigger_args):
+        """
+        Same arguments as ``BaseScheduler.add_job``.
+        :raises ConflictingIdError: if the id is taken and ``replace_existing`` is False
+        """
+        job = self.build_job(func, trigger, args, kwargs, id, name, **trigger_args)
+        try:
+            self.jobstore.add_job(job)
+        except ConflictingIdError:
+            if not replace_existing:
+                raise
+            self.jobstore.update_job(job)
+        return job
+
+    def build_job(self, func, trigger=None, args=None, kwargs=None, id=None, name=None, **options):
+        """
+        Builds a job the way ``BaseScheduler.add_job`` does, with its first run time set.
+        """
+        job_options = {key: options.pop(key) for key in
+                       ('misfire_grace_time', 'coalesce', 'max_instances', 'next_run_time', 'executor')
+                       if key in options}
+        job_kwargs = dict(self.scheduler._job_defaults, executor='default')
+        job_kwargs.update(job_options)
+        job_kwargs.update({
+            'trigger': self.scheduler._create_trigger(trigger, options),
+            'func': func,
+            'args': tuple(args) if args is not None else (),
+            'kwargs': dict(kwargs) if kwargs is not None else {},
+            'id': id,
+            'name': name,
+        })
+        with self._lock:
+            job = Job(self.scheduler, **job_kwargs)
+        if 'next_run_time' not in job_options:
+            job._modify(next_run_time=job.trigger.get_next_fire_time(None, self._now()))
+        return job
+
+    def modify_job(self, job_id, **changes):
+        """
+        :raises JobLookupError: if the job doesn't exist
+        """
+        job = self.jobstore.lookup_job(job_id)
+        if job is None:
+            raise JobLookupError(job_id)
+        job._modify(**changes)
+        self.jobstore.update_job(job)
+        return job
+
+    def reschedule_job(self, job_id, trigger, **trigger_args):
+        trigger = self.scheduler._create_trigger(trigger, trigger_args)
+        return self.modify_job(job_id, trigger=trigger,
+                               next_run_time=trigger.get_next_fire_time(None, self._now()))
+
+    def pause_job(self, job_id):
+        return self.modify_job(job_id, next_run_time=None)
+
+    def resume_job(self, job_id):
+        job = self.jobstore.lookup_job(job_id)
+        if job is None:
+            raise JobLookupError(job_id)
+        next_run_time = job.trigger.get_next_fire_time(None, self._now())
+        if next_run_time is None:
+            self.remove_job(job_id)
+            return None
+        return self.modify_job(job_id, next_run_time=next_run_time)
+
+    def run_job(self, job_id):
+        """
+        Makes the job due now, the scheduler runs it on its next wakeup.
+        """
+        return self.modify_job(job_id, next_run_time=self._now())
+
+    def remove_job(self, job_id):
+        self.jobstore.remove_job(job_id)
+
+    def add_jobs(self, jobs, replace_existing=False):
+        """
+        Adds jobs made with ``build_job`` in one transaction.
+        :raises ConflictingIdError: if an id is taken and ``replace_existing`` is False
+        """
+        jobs = list(jobs)
+        self.jobstore.add_jobs(jobs, replace_existing)
+        return jobs
+
+    def pause_jobs(self, job_ids):
+        """
+        Pauses the jobs that exist among ``job_ids``.
+        :return: list of paused jobs
+        """
+        jobs = list(self.jobstore.lookup_jobs(job_ids).values())
+        for job in jobs:
+            job._modify(next_run_time=None)
+        self.jobstore.update_jobs(jobs)
+        return jobs
+
+    def resume_jobs(self, job_ids):
+        """
+        Resumes the jobs that exist among ``job_ids``, jobs whose trigger
+        has no fire time left are removed.
+        :return: list of resumed jobs
+        """
+        now = self._now()
+        resumed, finished = [], []
+        for job in self.jobstore.lookup_jobs(job_ids).values():
+            next_run_time = job.trigger.get_next_fire_time(None, now)
+            if next_run_time is None:
+                finished.append(job.id)
+            else:
+                job._modify(next_run_time=next_run_time)
+                resumed.append(job)
+        self.jobstore.update_jobs(resumed)
+        if finished:
+            self.jobstore.remove_jobs(finished)
+        return resumed
+
+    def remove_jobs(self, job_ids):
+        """
+        :return: number of jobs removed
+        """
+        removed = self.jobstore.remove_jobs(job_ids)
+        return removed
+
+    def forecast(self, days=7, limit=None):
+        """
+        Fire times of every scheduled job over the next ``days`` days, see jobs.forecast.
+        :param int limit: at most this many fire times per job
+        :return: dict of job id -> list of fire times, empty for paused jobs
+        """
+        from .forecast import forecast
+
+        return forecast(self.jobstore.get_all_jobs(), self._now(), days, limit)
+
+    def _now(self):
+        return datetime.now(self.scheduler.timezone)
+
+
+_shared_control = None
+_shared_lock = Lock()
+
+
+def shared_control():
+    """
+    JobControl kept for the life of the process. Its job store caches the reconstituted
+    jobs, so repeated reads such as forecasts only load the rows that changed in between.
+    """
+    global _shared_control
+    with _shared_lock:
+        if _shared_control is None:
+            _shared_control = JobControl()
+        return _shared_control
+
+
+def notify():
+    """
+    Tells the scheduler that the job store changed. Fire and forget.
+    On PostgreSQL this is a NOTIFY on the default database, delivered to the scheduler
+    nodes on every host once the surrounding transaction commits. Other databases get
+    a datagram to JOBS_SCHEDULER_CONTROL, on the scheduler's host.
+    """
+    connection = connections["default"]
+    if connection.vendor == 'postgresql':
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('NOTIFY %s' % CHANNEL)
+        except DatabaseError as e:
+            LOGGER.warning('Unable to notify the scheduler: %s', e)
+        return
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(WAKEUP, tuple(settings.JOBS_SCHEDULER_CONTROL))
+    except OSError as e:
+        LOGGER.warning('Unable to notify the scheduler: %s', e)
+    finally:
+        sock.close()
+
+
+class ControlListener(object):
+    """
+    Runs in the scheduler process: on every change notification the job store cache
+    is invalidated and the scheduler woken up to look for new or changed jobs.
+    Datagrams are received on ``address``; on PostgreSQL a dedicated connection also
+    LISTENs for the NOTIFY of ``notify()``. Between notifications the scheduler sleeps
+    until its next run time without reading the table.
+    """
+
+    def __init__(self, scheduler, jobstore, address=None):
+        self.scheduler = scheduler
+        self.jobstore = jobstore
+        self.address = tuple(address or settings.JOBS_SCHEDULER_CONTROL)
+        self._sock = None
+        self._listening = False
+
+    def start(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind(self.address)
+        Thread(target=self._run, name='scheduler-control', daemon=True).start()
+        if connections["default"].vendor == 'postgresql':
+            self._listening = True
+            Thread(target=self._listen, name='scheduler-notify', daemon=True).start()
+
+    def stop(self):
+        self._listening = False
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _changed(self):
+        self.jobstore.invalidate()
+        self.scheduler.wakeup()
+
+    def _run(self):
+        while True:
+            try:
+                data, _ = self._sock.recvfrom(64)
+            except (OSError, AttributeError):
+                break
+            if data == WAKEUP:
+                self._changed()
+
+    def _listen(self):
+        connected = False
+        while self._listening:
+            try:
+                conn = self._connect()
+            except Exception as e:
+                LOGGER.warning('Unable to listen for job store changes: %s', e)
+                time.sleep(LISTEN_RETRY)
+                continue
+            try:
+                if connected:
+                    # Changes made while reconnecting went unnoticed
+                    self._changed()
+                connected = True
+                while self._listening:
+                    if select.select([conn], [], [], LISTEN_TIMEOUT)[0]:
+                        conn.poll()
+                        if conn.notifies:
+                            del conn.notifies[:]
+                            self._changed()
+            except Exception as e:
+                LOGGER.warning('Job store change notifications interrupted: %s', e)
+                time.sleep(LISTEN_RETRY)
+            finally:
+                conn.close()
+
+    def _connect(self):
+        # Outside of Django's connection handling, the connection stays in LISTEN mode
+        wrapper = connections["default"]
+        conn = wrapper.get_new_connection(wrapper.get_connection_params())
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute('LISTEN %s' % CHANNEL)
+        return conn
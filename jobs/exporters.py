@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+import os
+import csv
+import gzip
+import json
+import time
+import logging
+import datetime
+from decimal import Decimal
+
+import xlwt
+from django.conf import settings
+from django.utils.timezone import make_naive
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+LOGGER = logging.getLogger("jobs.exporters")
+
+# Rows pulled from the cursor per fetchmany() round trip
+FETCH_SIZE = getattr(settings, 'JOBS_EXPORT_FETCH_SIZE', 2000)
+
+
+class BaseWriter(object):
+    """
+    Writes the rows of one script to one or more files without keeping them in memory.
+    When ``max_rows`` data rows have been written the writer rolls over to a new
+    sheet or file, so a result set never hits the format's row limit.
+    Values are converted a column at a time: the type of a column is taken from its
+    first non-null value, ``native_types`` are written as they are, ``conversions``
+    maps other types to a conversion and anything else is written as text. Formats
+    without time zones get aware datetimes in the local time (settings.TIME_ZONE).
+    :param str path_base: target path without extension
+    :param int max_rows: data rows per sheet/file (0 means the format limit)
+    """
+    extension = None
+    row_limit = None
+    native_types = (str, int, float, datetime.datetime, datetime.date)
+    conversions = {Decimal: float}
+    aware_datetimes = True
+    # Columnar writers get each batch as a list of columns in _write_columns()
+    columnar = False
+
+    def __init__(self, path_base, max_rows=0):
+        self.path_base = path_base
+        # Anything but a positive limit means the format's own
+        self.max_rows = min(max_rows, self.row_limit) if max_rows and max_rows > 0 else self.row_limit
+        self.paths = []
+        self.headers = None
+        self.types = None
+        self.rows = 0
+        self._converters = None
+        self._part_rows = 0
+        self._parts = 0
+
+    def open(self, headers):
+        self.headers = headers
+        self.types = [None] * len(headers)
+        self._converters = [None] * len(headers)
+        self._next_part()
+
+    def write_rows(self, rows):
+        self._detect_types(rows)
+        while rows:
+            if self._part_rows >= self.max_rows:
+                self._next_part()
+            room = self.max_rows - self._part_rows
+            chunk, rows = (rows, None) if len(rows) <= room else (rows[:room], rows[room:])
+            self._write_chunk(chunk)
+            self._part_rows += len(chunk)
+            self.rows += len(chunk)
+
+    def close(self):
+        raise NotImplementedError
+
+    def _write_chunk(self, rows):
+        if not self.columnar and not any(self._converters):
+            self._write_batch(rows)
+            return
+        columns = list(zip(*rows))
+        for col, converter in enumerate(self._converters):
+            if converter is not None:
+                columns[col] = [None if value is None else converter(value) for value in columns[col]]
+        if self.columnar:
+            self._write_columns(columns)
+        else:
+            self._write_batch(list(zip(*columns)))
+
+    def _detect_types(self, rows):
+        for col, _type in enumerate(self.types):
+            if _type is not None:
+                continue
+            sample = next((row[col] for row in rows if row[col] is not None), None)
+            if sample is not None:
+                self.types[col] = type(sample)
+                self._converters[col] = self._converter(sample)
+
+    def _converter(self, sample):
+        if hasattr(sample, 'read'):
+            # LOB locators
+            return _read_lob
+        if not self.aware_datetimes and isinstance(sample, datetime.datetime) and sample.tzinfo is not None:
+            # timestamptz columns of PostgreSQL
+            return _naive_datetime
+        for _type, conversion in self.conversions.items():
+            if isinstance(sample, _type):
+                return conversion
+        if isinstance(sample, self.native_types):
+            return None
+        return str
+
+    def _next_part(self):
+        self._parts += 1
+        self._part_rows = 0
+        self._start_part()
+
+    def _start_part(self):
+        raise NotImplementedError
+
+    def _write_batch(self, rows):
+        raise NotImplementedError
+
+    def _write_columns(self, columns):
+        raise NotImplementedError
+
+    def _part_path(self):
+        suffix = '' if self._parts == 1 else '_%d' % self._parts
+        return '%s%s%s' % (self.path_base, suffix, self.extension)
+
+
+def _read_lob(value):
+    return value.read()
+
+
+def _naive_datetime(value):
+    return value if value.tzinfo is None else make_naive(value)
+
+
+class XlsWriter(BaseWriter):
+    """
+    Legacy xlwt writer, not streamed: the whole workbook lives in memory until
+    ``close()``. Extra sheets are added every 65535 rows. Use xlsx for large results.
+    """
+    extension = '.xls'
+    row_limit = 65535
+    aware_datetimes = False
+
+    def open(self, headers):
+        self._workbook = xlwt.Workbook()
+        self._sheet_name = os.path.basename(self.path_base)[:28]
+        self._date_style = xlwt.easyxf(num_format_str='yyyy-mm-dd hh:mm:ss')
+        self._plain_style = xlwt.Style.default_style
+        super(XlsWriter, self).open(headers)
+        self.paths.append('%s%s' % (self.path_base, self.extension))
+
+    def _start_part(self):
+        name = self._sheet_name if self._parts == 1 else '%s_%d' % (self._sheet_name, self._parts)
+        self._sheet = self._workbook.add_sheet(name, cell_overwrite_ok=True)
+        for col, header in enumerate(self.headers):
+            self._sheet.write(0, col, header)
+
+    def _write_batch(self, rows):
+        styles = [self._date_style if _type is not None and issubclass(_type, datetime.date)
+                  else self._plain_style for _type in self.types]
+        write = self._sheet.write
+        for _row, row in enumerate(rows, self._part_rows + 1):
+            for col, value in enumerate(row):
+                if value is not None:
+                    write(_row, col, value, styles[col])
+
+    def close(self):
+        self._workbook.save(self.paths[0])
+        return self.paths
+
+
+class XlsxWriter(BaseWriter):
+    """
+    Streaming xlsx writer, rows are flushed to disk as soon as they are written
+    (xlsxwriter ``constant_memory`` mode). Extra sheets are added at the row limit.
+    """
+    extension = '.xlsx'
+    row_limit = 1048575
+    aware_datetimes = False
+
+    def open(self, headers):
+        if xlsxwriter is None:
+            raise RuntimeError('xlsxwriter is required for the xlsx export format')
+        self._workbook = xlsxwriter.Workbook(
+            '%s%s' % (self.path_base, self.extension),
+            {'constant_memory': True, 'default_date_format': 'yyyy-mm-dd hh:mm:ss', 'remove_timezone': True}
+        )
+        self._sheet_name = os.path.basename(self.path_base)[:28]
+        super(XlsxWriter, self).open(headers)
+        self.paths.append('%s%s' % (self.path_base, self.extension))
+
+    def _start_part(self):
+        name = self._sheet_name if self._parts == 1 else '%s_%d' % (self._sheet_name, self._parts)
+        self._sheet = self._workbook.add_worksheet(name)
+        self._sheet.write_row(0, 0, self.headers)
+
+    def _write_batch(self, rows):
+        write_row = self._sheet.write_row
+        for _row, row in enumerate(rows, self._part_rows + 1):
+            write_row(_row, 0, row)
+
+    def close(self):
+        self._workbook.close()
+        return self.paths
+
+
+class CsvWriter(BaseWriter):
+    """
+    CSV writer, a new file is started every ``max_rows`` rows.
+    The csv module formats values itself, so only LOBs need converting.
+    """
+    extension = '.csv'
+    row_limit = 10000000
+    native_types = (object, )
+    conversions = {}
+
+    def __init__(self, path_base, max_rows=0):
+        super(CsvWriter, self).__init__(path_base, max_rows)
+        self._fp = None
+
+    def _open_file(self, path):
+        # utf-8-sig so that Excel detects the encoding
+        return open(path, 'w', newline='', encoding='utf-8-sig')
+
+    def _start_part(self):
+        if self._fp:
+            self._fp.close()
+        path = self._part_path()
+        self._fp = self._open_file(path)
+        self._csv = csv.writer(self._fp)
+        self._csv.writerow(self.headers)
+        self.paths.append(path)
+
+    def _write_batch(self, rows):
+        self._csv.writerows(rows)
+
+    def close(self):
+        if self._fp:
+            self._fp.close()
+            self._fp = None
+        return self.paths
+
+
+class GzipCsvWriter(CsvWriter):
+    extension = '.csv.gz'
+
+    def _open_file(self, path):
+        return gzip.open(path, 'wt', newline='', encoding='utf-8-sig')
+
+
+def _json_number(value):
+    return int(value) if value == value.to_integral_value() else float(value)
+
+
+def _isoformat(value):
+    return value.isoformat()
+
+
+class JsonLinesWriter(BaseWriter):
+    """
+    One JSON object per line keyed by column name, numbers stay numbers and
+    dates are written in ISO 8601.
+    """
+    extension = '.jsonl'
+    row_limit = 10000000
+    native_types = (str, int, float, bool)
+    conversions = {Decimal: _json_number, datetime.date: _isoformat, datetime.time: _isoformat}
+
+    def __init__(self, path_base, max_rows=0):
+        super(JsonLinesWriter, self).__init__(path_base, max_rows)
+        self._fp = None
+
+    def _start_part(self):
+        if self._fp:
+            self._fp.close()
+        path = self._part_path()
+        self._fp = open(path, 'w', encoding='utf-8')
+        self._encode = json.JSONEncoder(ensure_ascii=False, check_circular=False).encode
+        self.paths.append(path)
+
+    def _write_batch(self, rows):
+        headers, encode = self.headers, self._encode
+        self._fp.write(''.join(encode(dict(zip(headers, row))) + '\n' for row in rows))
+
+    def close(self):
+        if self._fp:
+            self._fp.close()
+            self._fp = None
+        return self.paths
+
+
+class ParquetWriter(BaseWriter):
+    """
+    Parquet through pyarrow, every batch becomes a row group. The schema is taken
+    from the first batch, columns that were all null in it are stored as text.
+    """
+    extension = '.parquet'
+    row_limit = 100000000
+    native_types = (str, int, float, bool, Decimal, datetime.datetime, datetime.date, bytes)
+    conversions = {}
+    columnar = True
+
+    def __init__(self, path_base, max_rows=0):
+        if pa is None:
+            raise RuntimeError('pyarrow is required for the parquet export format')
+        super(ParquetWriter, self).__init__(path_base, max_rows)
+        self._writer = None
+        self._schema = None
+
+    def _start_part(self):
+        self._close_part()
+        self.paths.append(self._part_path())
+
+    def _write_columns(self, columns):
+        if self._schema is None:
+            arrays = [pa.array(column) for column in columns]
+            self._schema = pa.schema([
+                pa.field(name, pa.string() if array.type == pa.null() else array.type)
+                for name, array in zip(self.headers, arrays)
+            ])
+        for col, field in enumerate(self._schema):
+            if field.type == pa.string() and self.types[col] is not None and self.types[col] is not str:
+                columns[col] = [None if value is None else str(value) for value in columns[col]]
+        table = pa.Table.from_arrays([pa.array(column, type=field.type)
+                                      for column, field in zip(columns, self._schema)],
+                                     schema=self._schema)
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.paths[-1], self._schema)
+        self._writer.write_table(table)
+
+    def _close_part(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def close(self):
+        if self._writer is None and self.paths and self._schema is None:
+            # No rows, still leave a file with the column names
+            schema = pa.schema([pa.field(name, pa.string()) for name in self.headers])
+            pq.write_table(schema.empty_table(), self.paths[-1])
+        self._close_part()
+        return self.paths
+
+
+WRITERS = {
+    'xls': XlsWriter,
+    'xlsx': XlsxWriter,
+    'csv': CsvWriter,
+    'csv.gz': GzipCsvWriter,
+    'jsonl': JsonLinesWriter,
+    'parquet': ParquetWriter,
+}
+
+
+def register_writer(export_format, writer_class):
+    """
+    Makes ``writer_class`` (a BaseWriter subclass) available as ``export_format``.
+    """
+    WRITERS[export_format] = writer_class
+
+
+def export_cursor(cursor, path_base, export_format='xls', max_rows=0, fetch_size=None, timings=None):
+    """
+    Streams the result of an executed cursor into files.
+    Rows are pulled with ``fetchmany`` so only one batch is held in memory at a time.
+    :param cursor: DB-API cursor with an executed query
+    :param str path_base: target path without extension
+    :param str export_format: one of ``WRITERS``
+    :param int max_rows: data rows per sheet/file before rolling over
+    :param int fetch_size: rows per fetchmany() call
+    :param dict timings: when given, 'fetch' and 'write' seconds are added to it
+    :return: (list of written file paths, row count)
+    """
+    fetch_size = fetch_size or FETCH_SIZE
+    writer = WRITERS[export_format](path_base, max_rows)
+    started = time.time()
+    fetching = writing = 0
+
+    # Server side cursors only describe the result after the first fetch
+    tick = time.perf_counter()
+    rows = cursor.fetchmany(fetch_size)
+    fetching += time.perf_counter() - tick
+    writer.open([field[0] for field in cursor.description])
+    try:
+        while rows:
+            tick = time.perf_counter()
+            writer.write_rows(rows)
+            fetched = time.perf_counter()
+            rows = cursor.fetchmany(fetch_size)
+            writing += fetched - tick
+            fetching += time.perf_counter() - fetched
+    finally:
+        tick = time.perf_counter()
+        paths = writer.close()
+        writing += time.perf_counter() - tick
+
+    elapsed = time.time() - started
+    if timings is not None:
+        timings['fetch'] = timings.get('fetch', 0) + fetching
+        timings['write'] = timings.get('write', 0) + writing
+    LOGGER.info('Exported %d rows to %s in %.2fs (%.0f rows/s)',
+                writer.rows, ', '.join(os.path.basename(p) for p in paths),
+                elapsed, writer.rows / elapsed if elapsed else 0)
+    return paths, writer.rows
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from itertools import islice
+
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.date import DateTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+
+_DATE_FIELDS = ('year', 'month', 'day', 'week', 'day_of_week')
+_TIME_FIELDS = ('hour', 'minute', 'second')
+_MICROSECOND = timedelta(microseconds=1)
+
+
+class FireCalendar(object):
+    """
+    Fire times of many triggers within one window [start, end).
+    Cron triggers are expanded from their fields instead of being stepped through
+    ``get_next_fire_time``: the days matching the date fields and the times of day
+    matching the time fields are computed once per distinct expression and shared
+    by every trigger using it. Windows with a UTC offset change, and trigger types
+    without a shortcut, are stepped through the trigger.
+    :param datetime start: aware start of the window
+    :param datetime end: aware end of the window, excluded
+    """
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self._days = {}  # (timezone, date field expressions) -> matching dates
+        self._times = {}  # time field expressions -> matching times of day
+        self._fixed_offset = {}  # timezone -> no UTC offset change within the window
+
+    def fire_times(self, trigger, start=None, limit=None):
+        """
+        :param start: first possible fire time when later than the window's start
+        :param int limit: at most this many fire times
+        :return: list of fire times in ascending order
+        """
+        start = max(start, self.start) if start is not None else self.start
+        if isinstance(trigger, CronTrigger) and self._is_fixed_offset(trigger.timezone):
+            times = self._cron_times(trigger, start)
+        elif isinstance(trigger, IntervalTrigger) and self._is_fixed_offset(trigger.timezone):
+            times = self._interval_times(trigger, start)
+        elif isinstance(trigger, DateTrigger):
+            times = [trigger.run_date] if start <= trigger.run_date < self.end else []
+        else:
+            times = self._stepped_times(trigger, start)
+        return list(islice(times, limit))
+
+    def _stepped_times(self, trigger, start):
+        previous, now = None, start
+        while True:
+            fire_time = trigger.get_next_fire_time(previous, now)
+            if fire_time is None or fire_time >= self.end:
+                return
+            if previous is not None and fire_time.timestamp() <= previous.timestamp():
+                # Wall clock arithmetic repeats the hour after a DST change, skip past it
+                now = datetime.fromtimestamp(previous.timestamp() + 3600, now.tzinfo)
+                continue
+            yield fire_time
+            previous, now = fire_time, fire_time + _MICROSECOND
+
+    def _interval_times(self, trigger, start):
+        # The trigger's own arithmetic, start_date plus whole intervals
+        first = trigger.start_date
+        end = self.end if trigger.end_date is None else min(self.end, trigger.end_date + _MICROSECOND)
+        step = trigger.interval_length
+        if start > first:
+            elapsed = (start - first).total_seconds()
+            first += timedelta(seconds=-(-elapsed // step) * step)
+        timestamp, end_timestamp = first.timestamp(), end.timestamp()
+        while timestamp < end_timestamp:
+            yield datetime.fromtimestamp(timestamp, trigger.timezone)
+            timestamp += step
+
+    def _cron_times(self, trigger, start):
+        timezone = trigger.timezone
+        start = start.astimezone(timezone)
+        end = self.end.astimezone(timezone)
+        if trigger.start_date is not None:
+            start = max(start, trigger.start_date)
+        if trigger.end_date is not None:
+            end = min(end, trigger.end_date + _MICROSECOND)
+        if start >= end:
+            return
+
+        fields = {field.name: field for field in trigger.fields}
+        times = self._matching_times(tuple(fields[name] for name in _TIME_FIELDS))
+        first_day = start.date()
+        for day in self._matching_days(timezone, tuple(fields[name] for name in _DATE_FIELDS)):
+            if day < first_day:
+                continue
+            # Fire times are whole seconds, the first day starts at the first one not before start
+            first = bisect_left(times, start.time()) if day == first_day else 0
+            for time_of_day in islice(times, first, None):
+                fire_time = datetime.combine(day, time_of_day, timezone)
+                if fire_time >= end:
+                    return
+                yield fire_time
+
+    def _matching_days(self, timezone, fields):
+        key = (timezone, tuple(str(field) for field in fields))
+        days = self._days.get(key)
+        if days is None:
+            # A wildcard matches every day, only the restricted fields are checked
+            fields = [field for field in fields if str(field) != '*']
+            day = self.start.astimezone(timezone).date()
+            last = self.end.astimezone(timezone).date()
+            days = []
+            while day <= last:
+                date = datetime.combine(day, time())
+                if all(field.get_next_value(date) == field.get_value(date) for field in fields):
+                    days.append(day)
+                day += timedelta(days=1)
+            self._days[key] = days
+        return days
+
+    def _matching_times(self, fields):
+        key = tuple(str(field) for field in fields)
+        times = self._times.get(key)
+        if times is None:
+            hours, minutes, seconds = [
+                [value for value in range(limit) if _matches(field, value)]
+                for field, limit in zip(fields, (24, 60, 60))
+            ]
+            times = self._times[key] = [time(hour, minute, second)
+                                        for hour in hours for minute in minutes for second in seconds]
+        return times
+
+    def _is_fixed_offset(self, timezone):
+        fixed = self._fixed_offset.get(timezone)
+        if fixed is None:
+            day = self.start.astimezone(timezone).date()
+            last = self.end.astimezone(timezone).date() + timedelta(days=1)
+            offset = datetime.combine(day, time(), timezone).utcoffset()
+            fixed = True
+            while day < last:
+                day += timedelta(days=1)
+                if datetime.combine(day, time(), timezone).utcoffset() != offset:
+                    fixed = False
+                    break
+            self._fixed_offset[timezone] = fixed
+        return fixed
+
+
+def _matches(field, value):
+    # Time fields only look at their own attribute of the date
+    date = datetime(2000, 1, 1).replace(**{field.name: value})
+    return field.get_next_value(date) == value
+
+
+def forecast(jobs, start, days=7, limit=None):
+    """
+    Fire times of scheduled jobs over the next ``days`` days, paused jobs have none.
+    :param jobs: APScheduler jobs, e.g. from ``JobControl().jobstore.get_all_jobs()``
+    :param datetime start: aware start of the forecast
+    :param int limit: at most this many fire times per job
+    :return: dict of job id -> list of fire times
+    """
+    calendar = FireCalendar(start, start + timedelta(days=days))
+    return {
+        job.id: calendar.fire_times(job.trigger, job.next_run_time, limit)
+        if job.next_run_time is not None else []
+        for job in jobs
+    }
+
+
+def hot_minutes(fire_times, top=20, min_jobs=2):
+    """
+    Minutes in which the most jobs fire.
+    :param dict fire_times: result of ``forecast``
+    :return: list of (minute, list of job ids), busiest first
+    """
+    minutes = defaultdict(list)
+    for job_id, times in fire_times.items():
+        for fire_time in times:
+            minutes[fire_time.replace(second=0, microsecond=0)].append(job_id)
+    busiest = sorted(((minute, job_ids) for minute, job_ids in minutes.items() if len(job_ids) >= min_jobs),
+                     key=lambda item: (-len(item[1]), item[0]))
+    return busiest[:top]
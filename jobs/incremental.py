@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+import os
+import gzip
+import shutil
+import logging
+import re
+from datetime import date, datetime
+from decimal import Decimal
+
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+
+from .models import ScriptFile
+
+LOGGER = logging.getLogger("jobs.incremental")
+
+# Placeholder of the single positional parameter, per jobs.db_pool.Target vendor
+PLACEHOLDERS = {
+    'oracle': ':1',
+    'sqlite': '?',
+    'postgresql': '%s',
+    'django': '%s',
+}
+
+_INT = re.compile(r'^-?\d+$')
+_DECIMAL = re.compile(r'^-?\d+\.\d+$')
+
+
+def delta_query(sql, column, value, vendor):
+    """
+    Wraps a script so that only rows past the watermark are returned, oldest first.
+    :param str value: last watermark as stored on the ScriptFile, empty on the first run
+    :return: (sql, params), params is None when there is nothing to bind
+    """
+    sql = 'SELECT * FROM (%s) w' % sql.strip().rstrip(';')
+    if not value:
+        return '%s ORDER BY w.%s' % (sql, column), None
+    return ('%s WHERE w.%s > %s ORDER BY w.%s' % (sql, column, PLACEHOLDERS[vendor], column),
+            [decode_watermark(value)])
+
+
+def encode_watermark(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+def decode_watermark(value):
+    """
+    Turns a stored watermark back into the type it was read as, so it compares
+    against the column natively instead of as text.
+    """
+    if _INT.match(value):
+        return int(value)
+    if _DECIMAL.match(value):
+        return Decimal(value)
+    try:
+        parsed = parse_datetime(value)
+    except ValueError:
+        parsed = None
+    return parsed if parsed is not None else value
+
+
+class WatermarkCursor(object):
+    """
+    Cursor proxy that remembers the highest value of the watermark column
+    among the rows fetched through it.
+    """
+
+    def __init__(self, cursor, column):
+        self.cursor = cursor
+        self.column = column
+        self.value = None
+        self._index = None
+
+    def execute(self, *args):
+        return self.cursor.execute(*args)
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    def fetchmany(self, size):
+        rows = self.cursor.fetchmany(size)
+        if rows:
+            if self._index is None:
+                self._index = self._column_index()
+            values = [row[self._index] for row in rows if row[self._index] is not None]
+            if values:
+                top = max(values)
+                if self.value is None or top > self.value:
+                    self.value = top
+        return rows
+
+    def close(self):
+        self.cursor.close()
+
+    def _column_index(self):
+        names = [field[0].lower() for field in self.cursor.description]
+        try:
+            return names.index(self.column.lower())
+        except ValueError:
+            raise ValueError('Watermark column %s is not in the result' % self.column)
+
+
+def running_path(script_file, extension):
+    return os.path.join(settings.JOBS_EXPORT_ROOT, 'running', str(script_file.pk),
+                        os.path.splitext(os.path.basename(str(script_file.script_file)))[0] + extension)
+
+
+def append_to_running(running, delta_paths, out):
+    """
+    Writes the running file followed by the rows of the delta files to ``out``.
+    The running file itself is only replaced by ``Increment.commit``.
+    Gzip members can be concatenated, so compressed files are appended the same way.
+    """
+    opener = gzip.open if out.endswith('.gz') else open
+    has_header = os.path.exists(running)
+    if has_header:
+        shutil.copyfile(running, out)
+    with opener(out, 'ab') as dst:
+        for path in delta_paths:
+            with opener(path, 'rb') as src:
+                if has_header:
+                    src.readline()
+                has_header = True
+                shutil.copyfileobj(src, dst)
+    for path in delta_paths:
+        os.remove(path)
+    return out
+
+
+class Increment(object):
+    """
+    Watermark (and running file) of one incremental script, applied once the
+    email with its export is sent.
+    """
+
+    def __init__(self, script_file, value, running=None, built=None):
+        self.script_file = script_file
+        self.value = value
+        self.running = running
+        self.built = built
+
+    def commit(self):
+        if self.value is not None:
+            ScriptFile.objects.filter(pk=self.script_file.pk).update(
+                watermark_value=encode_watermark(self.value))
+        if self.running:
+            os.makedirs(os.path.dirname(self.running), exist_ok=True)
+            tmp = self.running + '.tmp'
+            # The built file stays in the run's directory, it may be linked from the email
+            try:
+                os.link(self.built, tmp)
+            except OSError:
+                shutil.copyfile(self.built, tmp)
+            os.replace(tmp, self.running)
+        LOGGER.info('Script [%s] watermark advanced to %s', self.script_file, self.value)
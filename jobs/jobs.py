@@ -2,105 +2,256 @@
 import os
 import time
 import sys
-import xlwt
-import smtplib
 import json
 import logging
-import traceback 
 # import cx_Oracle
 from datetime import datetime
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
 from django.db import connections
 from django.core.files import File
-from email.mime.multipart import MIMEMultipart 
-from email.mime.text import MIMEText 
-from email import encoders
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.blocking import BlockingScheduler
 from int_ops.settings import BASE_DIR
-from .jobstores import DjangoJobStore, register_events, register_job
+from .admission import AdmissionThreadPoolExecutor, admission
+from .db_pool import db_pools
+from .exporters import export_cursor
+from .incremental import Increment, WatermarkCursor, append_to_running, delta_query, running_path
+from .mail import StreamedMessage, mail_queue, prepare_attachments
+from .metrics import RunMetrics
+from .render import render_cursor
+from .jobstores import create_jobstore, register_events, register_job
 from .models import EmailJob
+from .result_cache import result_cache
+from .result_storage import BufferedResultStorage
+from .retention import purge_executions
 
-scheduler = BackgroundScheduler()
-scheduler.add_jobstore(DjangoJobStore(), "default")
+LOGGER = logging.getLogger("jobs")
 
-register_events(scheduler)
 
-scheduler.start()
-LOGGER = logging.getLogger("jobs")
+def create_scheduler(scheduler_class=BlockingScheduler, **options):
+    """
+    Builds the scheduler that runs the jobs, it is started by ``manage.py runscheduler``
+    and nowhere else. Other processes use ``jobs.control.JobControl``.
+    """
+    options.setdefault('executors', {'default': AdmissionThreadPoolExecutor()})
+    scheduler = scheduler_class(**options)
+    # Changes made by other processes arrive through jobs.control.ControlListener,
+    # the table is only read again when one is notified. Datagrams only reach the
+    # JOBS_SCHEDULER_CONTROL host, so leasing nodes without PostgreSQL's NOTIFY also
+    # read it every JOBS_JOB_LEASE['sync_interval'] seconds
+    lease = settings.JOBS_JOB_LEASE
+    sync_interval = None
+    if lease['lease_seconds'] and connections["default"].vendor != 'postgresql':
+        sync_interval = lease['sync_interval']
+    scheduler.add_jobstore(create_jobstore(sync_interval=sync_interval, notify_changes=False), "default")
 
+    register_events(scheduler, BufferedResultStorage(**settings.JOBS_RESULT_BUFFER))
 
-def exp_oracle_script_job(job):
-    _exp_dir = 'exports%s%s' % (os.path.sep, datetime.now().strftime('%Y%m%d%H%M%S'))
+    # Internal jobs
+    register_job(scheduler, 'cron', replace_existing=True,
+                 **settings.JOBS_EXECUTION_RETENTION['cron'])(purge_executions)
+    return scheduler
+
+
+def _script_name(script_file):
+    f_path, f_ename = os.path.split(str(script_file.script_file))
+    f_name, f_ext = os.path.splitext(f_ename)
+    return f_name
 
-    os.makedirs(os.path.join(os.path.join(BASE_DIR, _exp_dir)), exist_ok=True)
 
-    files = job.script_files.all()
+def _read_script(job, script_file, exp_dir, metrics):
+    """
+    Reads a script and looks its export up in the result cache.
+    :return: (sql, cache key or None, cached file paths or None)
+    """
+    f_name = _script_name(script_file)
+    with open(str(script_file.script_file)) as rf:
+        _rf = File(rf)
+        sql = _rf.read()
 
+    # A delta depends on the watermark, never serve it from the cache
+    if not job.cache_ttl or script_file.watermark_column:
+        return sql, None, None
+    cache_key = result_cache.key(sql, job.conn_str, job.export_format, job.export_max_rows)
+    paths = result_cache.fetch(cache_key, job.cache_ttl, exp_dir, f_name)
+    if paths is not None:
+        metrics.count('cache_hits', 1, f_name)
+    return sql, cache_key, paths
+
+
+def _execute_script(target, conn, sql, script_file, metrics):
+    """
+    :return: cursor with the script's (or its delta's) rows
+    """
+    cursor = target.cursor(conn)
+    column = script_file.watermark_column
+    params = None
+    if column:
+        sql, params = delta_query(sql, column, script_file.watermark_value, target.vendor)
+        cursor = WatermarkCursor(cursor, column)
     try:
-        # tns_name = cx_Oracle.makedsn('ip','port','sid')
-        # conn = cx_Oracle.connect('username','password', tns_name)
+        with metrics.stage('query', _script_name(script_file)):
+            if params:
+                cursor.execute(sql, params)
+            else:
+                cursor.execute(sql)
+    except Exception:
+        cursor.close()
+        raise
+    return cursor
+
+
+def _finish_script(job, script_file, exp_dir, paths, rows, timings, metrics, cursor, cache_key):
+    """
+    Records an exported script and caches it, or prepares its Increment.
+    :return: (list of file paths to send, Increment or None)
+    """
+    f_name = _script_name(script_file)
+    for stage, seconds in timings.items():
+        metrics.add_stage(stage, seconds, f_name)
+    metrics.count('rows', rows, f_name)
+    metrics.count('bytes', sum(os.path.getsize(path) for path in paths), f_name)
 
-        conn = connections["default"]
+    if not script_file.watermark_column:
+        if cache_key:
+            result_cache.store(cache_key, paths, f_name)
+        return paths, None
 
-        for f in files:
+    increment = Increment(script_file, cursor.value)
+    if script_file.append_to_file and job.export_format in ('csv', 'csv.gz'):
+        extension = '.' + job.export_format
+        increment.running = running_path(script_file, extension)
+        increment.built = append_to_running(increment.running, paths,
+                                            os.path.join(exp_dir, f_name + '_all' + extension))
+        paths = [increment.built]
+    return paths, increment
+
+
+def _exp_script(job, script_file, exp_dir, metrics):
+    """
+    Runs one script against ``job.conn_str`` and exports its result, on a connection
+    borrowed from that target's pool (see jobs.db_pool). Scripts with a watermark
+    column only export the rows past their last watermark (see jobs.incremental).
+    Stage timings, rows and bytes go to ``metrics`` (a jobs.metrics.RunMetrics).
+    With ``job.render_process`` the files are written by a worker process (see jobs.render).
+    :return: (list of exported file paths, empty if the script failed;
+              Increment to commit once the email is sent, or None)
+    """
+    f_name = _script_name(script_file)
+    try:
+        sql, cache_key, paths = _read_script(job, script_file, exp_dir, metrics)
+        if paths is not None:
+            return paths, None
+
+        timings = {}
+        connecting = time.perf_counter()
+        with db_pools.connection(job.conn_str) as (target, conn):
+            metrics.add_stage('connect', time.perf_counter() - connecting, f_name)
+            cursor = _execute_script(target, conn, sql, script_file, metrics)
             try:
-                f_path, f_ename = os.path.split(str(f.script_file))
-                f_name, f_ext = os.path.splitext(f_ename)
-                with open(str(f.script_file)) as rf:
-                    _rf = File(rf)
-                    cursor = conn.cursor()
-                    cursor.execute(_rf.read())
-                    # cursor.execute('select name from jobs_djangojob')
-                    fields = cursor.description
-                    results = cursor.fetchall()
-                    workbook = xlwt.Workbook()
-                    sheet = workbook.add_sheet(f_name,cell_overwrite_ok=True)
-                    for field in range(0, len(fields)):
-                        sheet.write(0, field, fields[field][0])
-
-                    for row in range(1,len(results)+1):
-                        for col in range(0,len(fields)):
-                            sheet.write(row, col, u'%s' % results[row-1][col])        
-                    workbook.save(os.path.join(os.path.join(BASE_DIR, _exp_dir), '%s.xls' % f_name))
-            except (Exception) as e:
-                traceback.print_exc()
-                LOGGER.error('The Script [%s] Error: %s' % (f_name, e))
+                export = render_cursor if job.render_process else export_cursor
+                paths, rows = export(cursor,
+                                     os.path.join(exp_dir, f_name),
+                                     job.export_format,
+                                     job.export_max_rows,
+                                     timings=timings)
             finally:
                 cursor.close()
+        return _finish_script(job, script_file, exp_dir, paths, rows, timings, metrics, cursor, cache_key)
+    except (Exception) as e:
+        LOGGER.exception('The Script [%s] Error: %s' % (f_name, e))
+        metrics.count('script_errors', 1, f_name)
+        return [], None
+
+
+def _commit_increments(increments, sent):
+    """
+    Done callback of the email send, watermarks only advance when it went out.
+    """
+    if sent.exception() is not None:
+        LOGGER.warning('Email not sent, watermarks of %s kept', ', '.join(str(i.script_file) for i in increments))
+        return
+    try:
+        for increment in increments:
+            increment.commit()
+    except (Exception) as e:
+        LOGGER.exception('The Watermark Error: %s' % e)
+    finally:
+        connections["default"].close()
+
+
+def _record_send(metrics, sent):
+    # Delivery ends after the execution is stored, its time only reaches the registry
+    if sent.exception() is None:
+        metrics.add_stage('smtp', sent.send_seconds)
+        LOGGER.info('Report of [%s] sent in %.2fs', metrics.job_name, sent.send_seconds)
+
+
+def _send_report(job, f_stamp, exp_dir, exp_files, increments, metrics):
+    """
+    Builds the attachments of a run and queues its email.
+    :return: Future of the send, see MailQueue.send
+    """
+    with metrics.stage('attachments'):
+        attachments, links = prepare_attachments(
+            exp_files,
+            exp_dir,
+            zip_name='%s.zip' % f_stamp if job.zip_attachments else None,
+            link_size=job.attachment_link_size * 1024 * 1024
+        )
+    content = job.content or ''
+    if links:
+        content += '\n\n' + '\n'.join('%s: %s' % link for link in links)
+
+    # Attachments are streamed onto the SMTP connection by the mail queue's workers
+    msg = StreamedMessage(job.sender, job.to_email, job.subject, content, attachments)
+    sent = mail_queue.send(job.smtp_server, job.smtp_port, job.sender, job.sender_pass, msg)
+    sent.add_done_callback(partial(_record_send, metrics))
+    if increments:
+        sent.add_done_callback(partial(_commit_increments, increments))
+    return sent
+
+
+def exp_oracle_script_job(job):
+    """
+    Exports the scripts of an EmailJob and queues the email. The run first waits
+    for a slot of its target database (see jobs.admission).
+    :return: stage metrics of the run (see jobs.metrics.RunMetrics), stored with the execution
+    """
+    # Jobs store the EmailJob pk and load the current row at run time
+    if not isinstance(job, EmailJob):
+        job = EmailJob.objects.get(pk=job)
+    metrics = RunMetrics(job.name)
+
+    f_stamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    _exp_dir = os.path.join(settings.JOBS_EXPORT_ROOT, f_stamp)
+
+    os.makedirs(_exp_dir, exist_ok=True)
+
+    exp_files = []
+    increments = []
+
+    try:
+        files = list(job.script_files.all())
+
+        admitting = time.perf_counter()
+        with admission.admit(job.conn_str), \
+                ThreadPoolExecutor(max_workers=max(job.concurrency, 1),
+                                   thread_name_prefix='exp-%s' % job.pk) as executor:
+            metrics.add_stage('admission', time.perf_counter() - admitting)
+            futures = [executor.submit(_exp_script, job, f, _exp_dir, metrics) for f in files]
+            # Collected in script order so the attachments keep a stable order
+            for future in futures:
+                paths, increment = future.result()
+                exp_files.extend(paths)
+                if increment is not None:
+                    increments.append(increment)
     except (Exception) as e:
-        traceback.print_exc()
-        LOGGER.error('The DB Conn Error: %s' % e)
+        LOGGER.exception('The DB Conn Error: %s' % e)
     else:
-        msg = MIMEMultipart()
-        for file_name in os.listdir(os.path.join(os.path.join(BASE_DIR, _exp_dir))):
-            if file_name.find('.xls') == -1:
-                continue
-            exp_file = os.path.join(os.path.join(os.path.join(BASE_DIR, _exp_dir), file_name))
-            print(exp_file)
-            #xlsx类型附件 
-            att = MIMEText(open(exp_file,'rb').read(),'base64','utf-8')
-            att["Content-Type"] = 'application/octet-stream'
-            # att["Content-Disposition"] = 'attachment;filename=%s' % file_name
-            att.add_header('Content-Disposition', 'attachment', filename=('gbk', '', file_name))
-            # encoders.encode_base64(att)
-            msg.attach(att) 
-
-        msg['Subject'] = job.subject
-
-        body = MIMEText(job.content, 'plain', 'utf-8')
-        msg.attach(body)
-
-        # msg['Accept-Language'] = 'zh-CN'
-        # msg['Accept-Charset'] = 'ISO-8859-1,utf-8'
-        msg['From'] = job.sender
-        msg['To'] = job.to_email
-        try:
-            server = smtplib.SMTP_SSL(job.smtp_server, job.smtp_port)
-            server.login(job.sender, job.sender_pass)
-            server.send_message(msg)
-            server.close()       
-        except (Exception) as e:
-            traceback.print_exc()
-            LOGGER.error('The Email Send Error: %s' % e)
+        _send_report(job, f_stamp, _exp_dir, exp_files, increments, metrics)
     finally:
-        conn.close()
+        connections["default"].close()
+    return metrics.as_dict()
 
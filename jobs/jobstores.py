@@ -1,53 +1,182 @@
+import os
+import heapq
+import socket
 import logging
 import pickle
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Lock, RLock
+
 from apscheduler import events
 from apscheduler.events import JobExecutionEvent, JobSubmissionEvent
 from apscheduler.job import Job
 from apscheduler.jobstores.base import BaseJobStore, ConflictingIdError, JobLookupError
 from apscheduler.schedulers.base import BaseScheduler
 
-from django.core.exceptions import ObjectDoesNotExist
-from django.db import connections
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import F, Q
 
-from .models import DjangoJob
+from .control import notify
+from .models import DjangoJob, DjangoJobExecution, DjangoJobStats, RetentionPolicy
 from .result_storage import DjangoResultStorage
+from .serializers import PickleSerializer, get_serializer, load_job_state
 from .util import deserialize_dt, serialize_dt
 
 LOGGER = logging.getLogger("django_apscheduler")
 
+# Keeps IN (...) lists below the SQLite host parameter limit
+SYNC_BATCH_SIZE = 500
+
+
+class JobPkCache(object):
+    """
+    LRU map of job id (``DjangoJob.name``) to ``DjangoJob`` primary key, so event
+    handling can write executions without looking the job up first. ``reset`` loads
+    the whole table and grows ``maxsize`` to hold it.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._lock = Lock()
+        self._pks = OrderedDict()
+
+    def get(self, job_id):
+        """
+        :return: primary key of the job, or None if it doesn't exist
+        """
+        with self._lock:
+            pk = self._pks.get(job_id)
+            if pk is not None:
+                self._pks.move_to_end(job_id)
+                return pk
+
+        pk = DjangoJob.objects.filter(name=job_id).values_list('pk', flat=True).first()
+        if pk is not None:
+            self.set(job_id, pk)
+        return pk
+
+    def set(self, job_id, pk):
+        with self._lock:
+            self._pks[job_id] = pk
+            self._pks.move_to_end(job_id)
+            while len(self._pks) > self.maxsize:
+                self._pks.popitem(last=False)
+
+    def discard(self, job_id):
+        with self._lock:
+            self._pks.pop(job_id, None)
+
+    def reset(self, pks):
+        """
+        Replaces the cached ids by ``pks``, a dict of every job id -> primary key.
+        """
+        with self._lock:
+            self._pks = OrderedDict(pks)
+            self.maxsize = max(self.maxsize, len(self._pks))
+
+    def clear(self):
+        with self._lock:
+            self._pks.clear()
+
+
+job_pks = JobPkCache()
+
 
 class DjangoJobStore(BaseJobStore):
     """
     Stores jobs in a Django database.
+    Reconstituted jobs are cached in process, keyed by job id and the row ``version``,
+    so a poll only unpickles rows that changed since the previous one. A heap ordered
+    by next run time answers ``get_due_jobs`` and ``get_next_run_time`` from the cache.
     :param int pickle_protocol: pickle protocol level to use (for serialization), defaults to the
         highest available
+    :param serializer: ``jobs.serializers.BaseSerializer`` used to write job_state, defaults to
+        pickle. Rows in any format are readable whichever serializer writes.
+    :param float sync_interval: seconds during which the cache is trusted without checking
+        the table for changes made by other processes; None trusts it until ``invalidate()``,
+        for the scheduler, which is told about changes (see jobs.control.ControlListener)
+    :param bool notify_changes: notify the scheduler (``jobs.control.notify``) when a write
+        is committed; the scheduler's own store doesn't
+    :param float lease_seconds: enables leasing, for several scheduler nodes sharing one table.
+        Due jobs are claimed atomically for this long and only the claiming node runs them;
+        ``update_job`` releases the lease and expired leases can be claimed again.
+    :param str node_id: lease owner name of this node, defaults to host:pid
     """
 
-    def __init__(self, pickle_protocol=pickle.HIGHEST_PROTOCOL):
+    def __init__(self, pickle_protocol=pickle.HIGHEST_PROTOCOL, sync_interval=1, serializer=None,
+                 lease_seconds=None, node_id=None, notify_changes=True):
         super(DjangoJobStore, self).__init__()
         self.pickle_protocol = pickle_protocol
+        self.serializer = serializer or PickleSerializer(pickle_protocol)
+        self.sync_interval = sync_interval
+        self.lease_seconds = lease_seconds
+        self.node_id = node_id or '%s:%d' % (socket.gethostname(), os.getpid())
+        self.notify_changes = notify_changes
+        self._lock = RLock()
+        self._jobs = {}  # job id -> (version, Job)
+        self._heap = []  # (next run timestamp, job id, version)
+        self._contended = {}  # job id -> (version, retry timestamp) of jobs leased by other nodes
+        self._synced = None
+        self._generation = 0  # bumped by invalidate(), see _sync
 
     def lookup_job(self, job_id):
-        try:
-            job_state = DjangoJob.objects.get(name=job_id).job_state
-        except DjangoJob.DoesNotExist:
+        # Single row: processes that only edit a few jobs never load the whole table
+        row = DjangoJob.objects.filter(name=job_id).values_list('version', 'job_state').first()
+        if row is None:
+            self._uncache_job(job_id)
             return None
-        return self._reconstitute_job(job_state) if job_state else None
+        version, job_state = row
+        cached = self._jobs.get(job_id)
+        if cached and cached[0] == version:
+            return cached[1]
+        job = self._reconstitute_job(job_state)
+        self._cache_job(job_id, version, job)
+        return job
+
+    def invalidate(self):
+        """
+        Makes the next call check the table for changes, whatever the sync interval.
+        """
+        self._generation += 1
+        self._synced = None
 
     def get_due_jobs(self, now):
-        try:
-            return self._get_jobs(next_run_time__lte=serialize_dt(now))
-        except:
-            logging.exception("")
+        self._sync()
+        timestamp = now.timestamp()
+        due_entries = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= timestamp:
+                entry = heapq.heappop(self._heap)
+                if self._is_current(entry):
+                    due_entries.append(entry)
+            for entry in due_entries:
+                heapq.heappush(self._heap, entry)
+
+            if self.lease_seconds:
+                due_entries = [entry for entry in due_entries if not self._is_contended(entry, timestamp)]
+                claimed = self._claim(due_entries, now)
+                due_entries = [entry for entry in due_entries if entry[1] in claimed]
+            return [self._jobs[entry[1]][1] for entry in due_entries]
 
     def get_next_run_time(self):
-        try:
-            return deserialize_dt(DjangoJob.objects.first().next_run_time)
-        except AttributeError:  # no active jobs
-            return None
+        self._sync()
+        with self._lock:
+            while self._heap and not self._is_current(self._heap[0]):
+                heapq.heappop(self._heap)
+            if not self._heap:  # no active jobs
+                return None
+            if self._contended:
+                return self._next_uncontended_run_time()
+            return self._jobs[self._heap[0][1]][1].next_run_time
 
     def get_all_jobs(self):
-        jobs = self._get_jobs()
+        self._sync()
+        with self._lock:
+            jobs = [job for _, job in self._jobs.values()]
+        jobs.sort(key=lambda job: (job.next_run_time is not None,
+                                   job.next_run_time.timestamp() if job.next_run_time else 0))
         self._fix_paused_jobs_sorting(jobs)
         return jobs
 
@@ -57,61 +186,333 @@ class DjangoJobStore(BaseJobStore):
         ).exists():
             raise ConflictingIdError(job.id)
 
-        DjangoJob.objects.create(
+        django_job = DjangoJob.objects.create(
             name=job.id,
             next_run_time=serialize_dt(job.next_run_time),
-            job_state=pickle.dumps(job.__getstate__(), self.pickle_protocol)
+            job_state=self.serializer.dumps(job.__getstate__())
         )
-
+        job_pks.set(job.id, django_job.pk)
+        self._cache_job(job.id, 0, job)
+        self._changed()
 
     def update_job(self, job):
         updated = DjangoJob.objects.filter(name=job.id).update(
             next_run_time=serialize_dt(job.next_run_time),
-            job_state=pickle.dumps(job.__getstate__(), self.pickle_protocol)
+            job_state=self.serializer.dumps(job.__getstate__()),
+            version=F('version') + 1,
+            lease_owner=None,
+            lease_expires=None
         )
         if updated == 0:
+            self._uncache_job(job.id)
             raise JobLookupError(job.id)
 
+        # If another process bumped the row in between, the versions differ and
+        # the next sync reloads it
+        cached = self._jobs.get(job.id)
+        self._cache_job(job.id, cached[0] + 1 if cached else -1, job)
+        self._changed()
+
     def remove_job(self, job_id):
         deleted, _ = DjangoJob.objects.filter(name=job_id).delete()
+        job_pks.discard(job_id)
+        self._uncache_job(job_id)
         if deleted == 0:
             raise JobLookupError(job_id)
+        self._changed()
+
+    def lookup_jobs(self, job_ids):
+        """
+        :return: dict of job id -> Job for the ids that exist, in one query
+        """
+        jobs = {}
+        rows = (row for batch in _batches(list(job_ids)) for row in DjangoJob.objects.filter(
+            name__in=batch
+        ).values_list('name', 'version', 'job_state'))
+        for name, version, job_state in rows:
+            cached = self._jobs.get(name)
+            if cached and cached[0] == version:
+                jobs[name] = cached[1]
+                continue
+            try:
+                job = self._reconstitute_job(job_state)
+            except Exception:
+                self._logger.exception('Unable to restore job "%s"', name)
+                continue
+            self._cache_job(name, version, job)
+            jobs[name] = job
+        return jobs
+
+    def add_jobs(self, jobs, replace_existing=False):
+        """
+        Adds many jobs in one transaction: one query for the ids that exist, then
+        ``bulk_create`` for the new jobs and one UPDATE statement for the replaced ones.
+        :raises ConflictingIdError: if a job exists and ``replace_existing`` is False,
+            nothing is written then
+        """
+        jobs = list(jobs)
+        with transaction.atomic():
+            existing = self._existing([job.id for job in jobs])
+            if existing and not replace_existing:
+                raise ConflictingIdError(next(iter(existing)))
+
+            new = [job for job in jobs if job.id not in existing]
+            rows = DjangoJob.objects.bulk_create([
+                DjangoJob(name=job.id,
+                          next_run_time=serialize_dt(job.next_run_time),
+                          job_state=self.serializer.dumps(job.__getstate__()))
+                for job in new
+            ], batch_size=SYNC_BATCH_SIZE)
+            self._bulk_update([job for job in jobs if job.id in existing], existing)
+
+        for job, row in zip(new, rows):
+            # Backends that don't return ids from bulk_create (SQLite) resolve them lazily
+            if row.pk is not None:
+                job_pks.set(job.id, row.pk)
+            self._cache_job(job.id, 0, job)
+        self._changed()
+
+    def update_jobs(self, jobs):
+        """
+        ``update_job`` for many jobs, one UPDATE statement in one transaction.
+        :raises JobLookupError: if a job doesn't exist, nothing is written then
+        """
+        jobs = list(jobs)
+        with transaction.atomic():
+            existing = self._existing([job.id for job in jobs])
+            missing = [job.id for job in jobs if job.id not in existing]
+            if missing:
+                raise JobLookupError(missing[0])
+            self._bulk_update(jobs, existing)
+        self._changed()
+
+    def remove_jobs(self, job_ids):
+        """
+        Removes the jobs that exist among ``job_ids`` with a single DELETE.
+        :return: number of jobs removed
+        """
+        job_ids = list(job_ids)
+        removed = 0
+        with transaction.atomic():
+            for batch in _batches(job_ids):
+                # Executions and stats go along in one DELETE per table
+                _, deleted = DjangoJob.objects.filter(name__in=batch).delete()
+                removed += deleted.get(DjangoJob._meta.label, 0)
+        for job_id in job_ids:
+            job_pks.discard(job_id)
+            self._uncache_job(job_id)
+        if removed:
+            self._changed()
+        return removed
+
+    def _existing(self, job_ids):
+        """
+        :return: dict of job id -> (pk, version) for the ids that exist
+        """
+        existing = {}
+        for batch in _batches(job_ids):
+            existing.update(
+                (name, (pk, version)) for name, pk, version in DjangoJob.objects.filter(
+                    name__in=batch
+                ).values_list('name', 'pk', 'version')
+            )
+        return existing
+
+    def _bulk_update(self, jobs, existing):
+        # Callers run this in a transaction, after reading ``existing``.
+        # One prepared UPDATE executed per row: bulk_update's CASE WHEN grows with the batch
+        if not jobs:
+            return
+        connection = connections["default"]
+        qn = connection.ops.quote_name
+        next_run_time = DjangoJob._meta.get_field('next_run_time')
+        job_state = DjangoJob._meta.get_field('job_state')
+        sql = 'UPDATE %s SET %s = %%s, %s = %%s, %s = %s + 1, %s = NULL, %s = NULL WHERE %s = %%s' % (
+            qn(DjangoJob._meta.db_table), qn('next_run_time'), qn('job_state'), qn('version'), qn('version'),
+            qn('lease_owner'), qn('lease_expires'), qn('id'))
+        with connection.cursor() as c:
+            c.executemany(sql, [
+                (next_run_time.get_db_prep_value(serialize_dt(job.next_run_time), connection),
+                 job_state.get_db_prep_value(self.serializer.dumps(job.__getstate__()), connection),
+                 existing[job.id][0])
+                for job in jobs
+            ])
+        for job in jobs:
+            # A row bumped by another process in between no longer matches, the next sync reloads it
+            self._cache_job(job.id, existing[job.id][1] + 1, job)
 
     def remove_all_jobs(self):
         with connections["default"].cursor() as c:
-            c.execute("""
-                DELETE FROM django_apscheduler_djangojobexecution;
-                DELETE FROM django_apscheduler_djangojob
-            """)
+            # Tables referencing DjangoJob first, retention policies for all jobs stay
+            c.execute("DELETE FROM %s WHERE %s IS NOT NULL" % (RetentionPolicy._meta.db_table,
+                                                               RetentionPolicy._meta.get_field('job').column))
+            c.execute("DELETE FROM %s" % DjangoJobStats._meta.db_table)
+            c.execute("DELETE FROM %s" % DjangoJobExecution._meta.db_table)
+            c.execute("DELETE FROM %s" % DjangoJob._meta.db_table)
+        job_pks.clear()
+        with self._lock:
+            self._jobs.clear()
+            self._heap = []
+        self._changed()
+
+    def _changed(self):
+        if self.notify_changes:
+            # Outside of a transaction this runs right away
+            transaction.on_commit(notify)
 
     def _reconstitute_job(self, job_state):
-        job_state = pickle.loads(job_state)
+        job_state = load_job_state(job_state)
         job_state['jobstore'] = self
         job = Job.__new__(Job)
         job.__setstate__(job_state)
         job._scheduler = self._scheduler
         job._jobstore_alias = self._alias
+        if job.next_run_time is not None:
+            job.next_run_time = deserialize_dt(job.next_run_time)
         return job
 
-    def _get_jobs(self, **filters):
-        job_states = DjangoJob.objects.filter(**filters).values_list('id', 'job_state')
-        jobs = []
-        failed_job_ids = set()
-        for job_id, job_state in job_states:
-            try:
-                jobs.append(self._reconstitute_job(job_state))
-            except:
-                self._logger.exception('Unable to restore job "%s" -- removing it', job_id)
-                failed_job_ids.add(job_id)
-
-        # Remove all the jobs we failed to restore
-        DjangoJob.objects.filter(name__in=failed_job_ids).delete()
-
-        def map_jobs(job):
-            job.next_run_time = deserialize_dt(job.next_run_time)
-            return job
+    def _cache_job(self, job_id, version, job):
+        with self._lock:
+            self._jobs[job_id] = (version, job)
+            self._contended.pop(job_id, None)
+            if job.next_run_time is not None:
+                heapq.heappush(self._heap, (job.next_run_time.timestamp(), job_id, version))
+
+    def _uncache_job(self, job_id):
+        # Heap entries of removed jobs are dropped lazily by _is_current
+        with self._lock:
+            self._jobs.pop(job_id, None)
+            self._contended.pop(job_id, None)
+
+    def _is_current(self, entry):
+        timestamp, job_id, version = entry
+        cached = self._jobs.get(job_id)
+        return (cached is not None and cached[0] == version
+                and cached[1].next_run_time is not None
+                and cached[1].next_run_time.timestamp() == timestamp)
+
+    def _is_contended(self, entry, timestamp):
+        contended = self._contended.get(entry[1])
+        return contended is not None and contended[0] == entry[2] and contended[1] > timestamp
+
+    def _next_uncontended_run_time(self):
+        """
+        Earliest run time, jobs leased by other nodes count at their lease expiry.
+        """
+        now = time.time()
+        candidates = []
+        entries = heapq.nsmallest(len(self._contended) + 1, filter(self._is_current, self._heap))
+        for timestamp, job_id, version in entries:
+            if self._is_contended((timestamp, job_id, version), now):
+                candidates.append(self._contended[job_id][1])
+            else:
+                candidates.append(timestamp)
+                break
+        next_run_time = self._jobs[self._heap[0][1]][1].next_run_time
+        return datetime.fromtimestamp(min(candidates), next_run_time.tzinfo)
+
+    def _claim(self, entries, now):
+        """
+        Leases the given due jobs to this node. A job is only claimed when its row still
+        has the version this node cached and nobody else holds an unexpired lease.
+        :return: set of claimed job ids
+        """
+        if not entries:
+            return set()
+        versions = {job_id: version for _, job_id, version in entries}
+        db_now = serialize_dt(now)
+        lease = dict(lease_owner=self.node_id,
+                     lease_expires=db_now + timedelta(seconds=self.lease_seconds))
+        free = Q(lease_expires__isnull=True) | Q(lease_expires__lt=db_now) | Q(lease_owner=self.node_id)
+
+        if connections["default"].features.has_select_for_update_skip_locked:
+            with transaction.atomic():
+                rows = DjangoJob.objects.select_for_update(skip_locked=True).filter(
+                    free, name__in=list(versions)
+                ).values_list('name', 'version')
+                claimed = {job_id for job_id, version in rows if versions[job_id] == version}
+                DjangoJob.objects.filter(name__in=claimed).update(**lease)
+        else:
+            claimed = set()
+            for job_id, version in versions.items():
+                if DjangoJob.objects.filter(free, name=job_id, version=version).update(**lease):
+                    claimed.add(job_id)
+
+        lost = set(versions) - claimed
+        if lost:
+            # Held by another node or changed since the last sync: reload them, and don't
+            # retry the ones still leased before their lease runs out
+            leases = dict(DjangoJob.objects.filter(name__in=lost).values_list('name', 'lease_expires'))
+            for job_id in lost:
+                expires = leases.get(job_id)
+                retry = deserialize_dt(expires).timestamp() if expires else now.timestamp() + 1
+                self._contended[job_id] = (versions[job_id], retry)
+            self.invalidate()
+        return claimed
+
+    def _sync(self):
+        """
+        Brings the cache up to date with the table. Only the (name, version) pairs are read,
+        job_state is fetched and unpickled only for new or changed rows.
+        """
+        if self._synced is not None and (self.sync_interval is None
+                                         or time.monotonic() - self._synced < self.sync_interval):
+            return
 
-        return list(map(map_jobs, jobs))
+        with self._lock:
+            # An invalidation arriving while the table is read may concern a change it missed
+            generation = self._generation
+            versions = {}
+            pks = {}
+            for job_id, version, pk in DjangoJob.objects.values_list('name', 'version', 'pk'):
+                versions[job_id] = version
+                pks[job_id] = pk
+            # Removed jobs go too, their events are dropped instead of written with a stale pk
+            job_pks.reset(pks)
+            for job_id in set(self._jobs) - set(versions):
+                self._uncache_job(job_id)
+
+            changed = [job_id for job_id, version in versions.items()
+                       if self._jobs.get(job_id, (None,))[0] != version]
+            failed_job_ids = set()
+            for i in range(0, len(changed), SYNC_BATCH_SIZE):
+                job_states = DjangoJob.objects.filter(
+                    name__in=changed[i:i + SYNC_BATCH_SIZE]
+                ).values_list('name', 'version', 'job_state')
+                for job_id, version, job_state in job_states:
+                    try:
+                        self._cache_job(job_id, version, self._reconstitute_job(job_state))
+                    except:
+                        self._logger.exception('Unable to restore job "%s" -- removing it', job_id)
+                        failed_job_ids.add(job_id)
+
+            # Remove all the jobs we failed to restore
+            if failed_job_ids:
+                DjangoJob.objects.filter(name__in=failed_job_ids).delete()
+
+            # Compact the heap once stale entries dominate it
+            if len(self._heap) > 2 * len(self._jobs) + 64:
+                self._heap = [entry for entry in self._heap if self._is_current(entry)]
+                heapq.heapify(self._heap)
+
+            if self._generation == generation:
+                self._synced = time.monotonic()
+
+
+def _batches(items, size=SYNC_BATCH_SIZE):
+    # Keeps IN lists under the backends' bound parameter limits
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def create_jobstore(**kwargs):
+    """
+    DjangoJobStore configured from settings.
+    """
+    kwargs.setdefault('serializer', get_serializer(settings.JOBS_JOB_STATE_FORMAT))
+    for key in ('lease_seconds', 'node_id'):
+        kwargs.setdefault(key, settings.JOBS_JOB_LEASE[key])
+    return DjangoJobStore(**kwargs)
 
 
 def event_name(code):
@@ -134,30 +535,30 @@ class _EventManager(object):
                 self._process_submission_event(event)
             elif isinstance(event, JobExecutionEvent):
                 self._process_execution_event(event)
+            elif event.code == events.EVENT_SCHEDULER_SHUTDOWN:
+                self.storage.close()
         except Exception as e:
             self.LOGGER.exception(str(e))
 
     def _process_submission_event(self, event):
         # type: (JobSubmissionEvent)->None
 
-        try:
-            job = DjangoJob.objects.get(name=event.job_id)
-        except ObjectDoesNotExist:
+        job_pk = job_pks.get(event.job_id)
+        if job_pk is None:
             self.LOGGER.warning("Job with id %s not found in database", event.job_id)
             return
 
-        self.storage.get_or_create_job_execution(job, event)
+        self.storage.get_or_create_job_execution(job_pk, event)
 
     def _process_execution_event(self, event):
         # type: (JobExecutionEvent)->None
 
-        try:
-            job = DjangoJob.objects.get(name=event.job_id)
-        except ObjectDoesNotExist:
+        job_pk = job_pks.get(event.job_id)
+        if job_pk is None:
             self.LOGGER.warning("Job with id %s not found in database", event.job_id)
             return
 
-        self.storage.register_job_executed(job, event)
+        self.storage.register_job_executed(job_pk, event)
 
 
 def register_events(scheduler, result_storage=None):
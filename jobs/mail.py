@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import queue
+import atexit
+import base64
+import smtplib
+import logging
+import zipfile
+from concurrent.futures import Future
+from email.message import Message
+from email.policy import compat32
+from email.utils import formatdate, getaddresses, make_msgid
+from threading import Lock, Thread
+
+from django.conf import settings
+
+from .util import export_url
+
+LOGGER = logging.getLogger("jobs.mail")
+
+# 57 input bytes make one 76 character base64 line
+_B64_BLOCK = 57 * 1024
+_POLICY = compat32.clone(linesep='\r\n')
+
+
+class StreamedMessage(object):
+    """
+    multipart/mixed message whose attachments are base64 encoded in blocks straight
+    onto the SMTP DATA stream, so no attachment is ever held in memory whole.
+    :param str sender: From address
+    :param str to: To header, addresses separated by ',' or ';'
+    :param str subject: Subject
+    :param str content: plain text body
+    :param list attachments: paths of the files to attach
+    """
+
+    def __init__(self, sender, to, subject, content, attachments):
+        self.sender = sender
+        self.to = to
+        self.subject = subject
+        self.content = content or ''
+        self.attachments = attachments
+        self.boundary = '===============%s==' % make_msgid().strip('<>').split('@')[0]
+
+    @property
+    def recipients(self):
+        return [addr for _, addr in getaddresses([self.to.replace(';', ',')]) if addr]
+
+    def iter_chunks(self):
+        """
+        Yields the message as CRLF terminated byte chunks.
+        """
+        yield _headers([
+            ('Content-Type', 'multipart/mixed', {'boundary': self.boundary}),
+            ('MIME-Version', '1.0', {}),
+            ('Subject', self.subject, {}),
+            ('From', self.sender, {}),
+            ('To', self.to, {}),
+            ('Date', formatdate(localtime=True), {}),
+        ])
+        delimiter = ('--%s\r\n' % self.boundary).encode()
+
+        for path in self.attachments:
+            yield delimiter
+            yield _headers([
+                ('Content-Type', 'application/octet-stream', {}),
+                ('Content-Transfer-Encoding', 'base64', {}),
+                ('Content-Disposition', 'attachment', {'filename': ('gbk', '', os.path.basename(path))}),
+            ])
+            with open(path, 'rb') as fp:
+                while True:
+                    block = fp.read(_B64_BLOCK)
+                    if not block:
+                        break
+                    yield base64.encodebytes(block).replace(b'\n', b'\r\n')
+
+        yield delimiter
+        yield _headers([
+            ('Content-Type', 'text/plain', {'charset': 'utf-8'}),
+            ('Content-Transfer-Encoding', 'base64', {}),
+        ])
+        yield base64.encodebytes(self.content.encode('utf-8')).replace(b'\n', b'\r\n')
+        yield ('--%s--\r\n' % self.boundary).encode()
+
+    def send(self, smtp):
+        """
+        Sends the message over a connected, logged in ``smtplib.SMTP`` session.
+        Base64 lines never start with '.', so no dot stuffing is needed.
+        :return: dict of refused recipients, like ``SMTP.sendmail``
+        """
+        recipients = self.recipients
+        smtp.ehlo_or_helo_if_needed()
+        code, resp = smtp.mail(self.sender)
+        if code != 250:
+            self._reset(smtp)
+            raise smtplib.SMTPSenderRefused(code, resp, self.sender)
+
+        refused = {}
+        for addr in recipients:
+            code, resp = smtp.rcpt(addr)
+            if code not in (250, 251):
+                refused[addr] = (code, resp)
+        if len(refused) == len(recipients):
+            self._reset(smtp)
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        code, resp = smtp.docmd('data')
+        if code != 354:
+            self._reset(smtp)
+            raise smtplib.SMTPDataError(code, resp)
+        for chunk in self.iter_chunks():
+            smtp.send(chunk)
+        smtp.send(b'.\r\n')
+        code, resp = smtp.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+    @staticmethod
+    def _reset(smtp):
+        try:
+            smtp.rset()
+        except smtplib.SMTPServerDisconnected:
+            pass
+
+
+def _headers(headers):
+    """
+    Header block of one part, terminated by the blank line.
+    """
+    msg = Message()
+    for name, value, params in headers:
+        msg.add_header(name, value, **params)
+    return b''.join(_POLICY.fold_binary(name, value) for name, value in msg.items()) + b'\r\n'
+
+
+def prepare_attachments(exp_files, exp_dir, zip_name=None, link_size=0):
+    """
+    Decides how exported files go out with the email.
+    :param list exp_files: exported file paths
+    :param str exp_dir: directory of this run's exports, a zip is written there
+    :param str zip_name: when given, all files are packed into one zip of that name first
+    :param int link_size: bytes above which a file is linked instead of attached, 0 attaches all
+    :return: (paths to attach, list of (file name, url) to link)
+    """
+    if zip_name and exp_files:
+        zip_path = os.path.join(exp_dir, zip_name)
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+            for path in exp_files:
+                zf.write(path, os.path.basename(path))
+        exp_files = [zip_path]
+
+    attachments, links = [], []
+    for path in exp_files:
+        if link_size and os.path.getsize(path) > link_size:
+            relative = os.path.relpath(path, settings.JOBS_EXPORT_ROOT).replace(os.path.sep, '/')
+            links.append((os.path.basename(path), export_url(relative)))
+        else:
+            attachments.append(path)
+    return attachments, links
+
+
+class SMTPConnectionPool(object):
+    """
+    Keeps logged in SMTP sessions per (server, port, sender) so that jobs firing
+    together don't all pay for the TLS handshake and the login.
+    :param float idle_timeout: seconds after which an idle session is closed instead of reused
+    :param int max_idle: idle sessions kept per key
+    """
+
+    def __init__(self, idle_timeout=60, max_idle=2):
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self._lock = Lock()
+        self._idle = {}  # key -> [(smtp, released at)]
+
+    def send_message(self, server, port, sender, password, msg, to_addrs=None):
+        """
+        Sends ``msg`` on a pooled session, a broken session is replaced and the send retried once.
+        """
+        key = (server, port, sender)
+        smtp = self._acquire(key)
+        if smtp is not None:
+            try:
+                self._send(smtp, msg, to_addrs)
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPResponseException, OSError) as e:
+                LOGGER.info('Pooled SMTP session to %s:%s failed (%s), reconnecting', server, port, e)
+                self._close(smtp)
+            else:
+                self._release(key, smtp)
+                return
+
+        smtp = self._connect(server, port, sender, password)
+        try:
+            self._send(smtp, msg, to_addrs)
+        except Exception:
+            self._close(smtp)
+            raise
+        self._release(key, smtp)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for sessions in idle.values():
+            for smtp, _ in sessions:
+                self._close(smtp)
+
+    def _acquire(self, key):
+        expired = []
+        smtp = None
+        with self._lock:
+            sessions = self._idle.get(key, [])
+            while sessions:
+                _smtp, released = sessions.pop()
+                if time.monotonic() - released > self.idle_timeout:
+                    expired.append(_smtp)
+                else:
+                    smtp = _smtp
+                    break
+        for _smtp in expired:
+            self._close(_smtp)
+        return smtp
+
+    def _release(self, key, smtp):
+        with self._lock:
+            sessions = self._idle.setdefault(key, [])
+            if len(sessions) < self.max_idle:
+                sessions.append((smtp, time.monotonic()))
+                return
+        self._close(smtp)
+
+    @staticmethod
+    def _send(smtp, msg, to_addrs):
+        if isinstance(msg, StreamedMessage):
+            msg.send(smtp)
+        else:
+            smtp.send_message(msg, to_addrs=to_addrs)
+
+    def _connect(self, server, port, sender, password):
+        smtp = smtplib.SMTP_SSL(server, port)
+        try:
+            smtp.login(sender, password)
+        except Exception:
+            self._close(smtp)
+            raise
+        return smtp
+
+    @staticmethod
+    def _close(smtp):
+        try:
+            smtp.quit()
+        except Exception:
+            smtp.close()
+
+
+class MailQueue(object):
+    """
+    Send queue drained by worker threads, so a slow SMTP server doesn't hold
+    the scheduler's executor thread. Workers start with the first message.
+    :param int workers: number of sender threads
+    :param SMTPConnectionPool pool: pool the workers send through
+    """
+
+    def __init__(self, workers=2, pool=None):
+        self.workers = workers
+        self.pool = pool or SMTPConnectionPool()
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = Lock()
+
+    def send(self, server, port, sender, password, msg, to_addrs=None):
+        """
+        Queues ``msg`` for delivery.
+        :return: Future resolved once the message is sent, with the seconds the
+            delivery took in its ``send_seconds``
+        """
+        self._start()
+        future = Future()
+        self._queue.put((future, (server, port, sender, password, msg, to_addrs)))
+        return future
+
+    def close(self):
+        """
+        Sends what is queued, then stops the workers and closes the pooled sessions.
+        """
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+        self.pool.close()
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = Thread(target=self._run, name='mail-sender-%d' % len(self._threads), daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            future, args = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            started = time.perf_counter()
+            try:
+                self.pool.send_message(*args)
+            except Exception as e:
+                LOGGER.error('The Email Send Error: %s', e)
+                future.set_exception(e)
+            else:
+                future.send_seconds = time.perf_counter() - started
+                future.set_result(None)
+
+
+mail_queue = MailQueue(settings.JOBS_MAIL['workers'],
+                       SMTPConnectionPool(settings.JOBS_MAIL['idle_timeout'], settings.JOBS_MAIL['max_idle']))
+# Deliver whatever is still queued when the process exits
+atexit.register(mail_queue.close)
@@ -0,0 +1,41 @@
+import os
+from importlib import import_module
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+import jobs.benchmarks
+from jobs.benchmarks import load_baseline, report, save_baseline
+
+
+class Command(BaseCommand):
+    help = 'Runs one of the benchmarks in jobs.benchmarks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', help='module name in jobs.benchmarks, e.g. serializers')
+        parser.add_argument('--number', type=int, default=2000, help='iterations per measurement')
+        parser.add_argument('--rows', type=int, default=1000000, help='rows of synthetic results (exporters, export)')
+        parser.add_argument('--sizes', default='1000,10000,100000',
+                            help='comma separated job counts (jobstore)')
+        parser.add_argument('--baseline', default=os.path.join(settings.BASE_DIR, 'benchmark-baseline.json'),
+                            help='file the baseline is read from and saved to')
+        parser.add_argument('--no-memory', action='store_true',
+                            help="don't trace memory, it slows allocation heavy code down")
+        parser.add_argument('--save-baseline', action='store_true', help='store this run as the baseline')
+
+    def handle(self, *args, **options):
+        name = options.pop('name')
+        baseline_path = options.pop('baseline')
+        save = options.pop('save_baseline')
+        jobs.benchmarks.TRACE_MEMORY = not options.pop('no_memory')
+        options['sizes'] = [int(size) for size in options['sizes'].split(',')]
+
+        benchmark = import_module('jobs.benchmarks.%s' % name)
+        measurements = benchmark.run(self.stdout, **options)
+        if not measurements:
+            return
+
+        report(self.stdout, name, measurements, load_baseline(baseline_path))
+        if save:
+            save_baseline(baseline_path, name, measurements)
+            self.stdout.write('Baseline saved to %s' % baseline_path)
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from jobs.retention import dedupe_executions
+
+
+class Command(BaseCommand):
+    help = 'Deletes duplicate executions of one run, run it before migrating to unique (job, run_time)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help='rows per transaction')
+
+    def handle(self, *args, **options):
+        self.stdout.write('deleted: %d' % dedupe_executions(options['batch_size']))
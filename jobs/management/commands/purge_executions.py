@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from jobs.retention import purge_executions
+
+
+class Command(BaseCommand):
+    help = 'Deletes or archives job executions older than their retention policy'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help='rows per transaction')
+        parser.add_argument('--dry-run', action='store_true', help='only count the executions')
+
+    def handle(self, *args, **options):
+        result = purge_executions(options['batch_size'], options['dry_run'])
+        self.stdout.write('deleted: %(delete)d, archived: %(archive)d' % result)
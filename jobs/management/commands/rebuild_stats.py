@@ -0,0 +1,19 @@
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from jobs.stats import rebuild_stats
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the hourly execution statistics from the stored executions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=2, help='days back from now')
+
+    def handle(self, *args, **options):
+        now = timezone.now() if settings.USE_TZ else datetime.now()
+        rows = rebuild_stats(now - timedelta(days=options['days']))
+        self.stdout.write('statistics rows written: %d' % rows)
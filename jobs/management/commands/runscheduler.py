@@ -0,0 +1,88 @@
+import signal
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from jobs.control import ControlListener
+from jobs.jobs import create_scheduler
+from jobs.metrics import MetricsServer
+from jobs.models import DjangoJobStats
+from jobs.render import render_pool
+from jobs.stats import rebuild_stats
+
+LOGGER = logging.getLogger("jobs")
+
+
+class Command(BaseCommand):
+    help = 'Runs the job scheduler, the only process that executes jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--asyncio', action='store_true',
+                            help='Run exports as asyncio pipelines (see JOBS_ASYNC) instead of a thread per run')
+
+    def handle(self, *args, **options):
+        if options['asyncio']:
+            asyncio.run(self._run_asyncio())
+            return
+
+        scheduler = create_scheduler()
+        listener, metrics_server = self._start_services(scheduler)
+
+        def shutdown(signum, frame):
+            if scheduler.running:
+                LOGGER.info('Received signal %d, shutting down the scheduler', signum)
+                scheduler.shutdown(wait=False)
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+
+        try:
+            scheduler.start()
+        finally:
+            listener.stop()
+            metrics_server.stop()
+            render_pool.shutdown()
+
+    async def _run_asyncio(self):
+        from apscheduler.schedulers.asyncio import AsyncIOScheduler
+        from jobs.pipeline import PipelineExecutor
+
+        scheduler = create_scheduler(AsyncIOScheduler, executors={'default': PipelineExecutor()})
+        listener, metrics_server = self._start_services(scheduler)
+
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+
+        def shutdown(signum):
+            if scheduler.running:
+                LOGGER.info('Received signal %d, shutting down the scheduler', signum)
+                scheduler.shutdown(wait=False)
+            stopped.set()
+
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, shutdown, signum)
+
+        try:
+            scheduler.start()
+            await stopped.wait()
+        finally:
+            listener.stop()
+            metrics_server.stop()
+            render_pool.shutdown()
+
+    def _start_services(self, scheduler):
+        if not DjangoJobStats.objects.exists():
+            # First start since the rollup was added, the admin shows the last two days
+            now = timezone.now() if settings.USE_TZ else datetime.now()
+            LOGGER.info('Filled in %d statistics rows', rebuild_stats(now - timedelta(days=2)))
+        listener = ControlListener(scheduler, scheduler._lookup_jobstore('default'))
+        listener.start()
+        metrics_server = MetricsServer(settings.JOBS_METRICS['address'])
+        metrics_server.start()
+        self.stdout.write('Scheduler started, control channel on %s:%d, metrics on %s:%d'
+                          % (listener.address + metrics_server.address))
+        return listener, metrics_server
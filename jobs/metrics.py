@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+import time
+import logging
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+
+from .stats import DURATION_BUCKETS
+
+LOGGER = logging.getLogger("jobs.metrics")
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class MetricsRegistry(object):
+    """
+    In-process counters and histograms, rendered in the Prometheus text format.
+    Series are created on first use, labels are passed as keyword arguments.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._metrics = {}  # name -> (type, help)
+        self._buckets = {}  # histogram name -> upper bounds
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts..., +Inf count, sum]
+
+    def describe(self, name, kind, help_text, buckets=DURATION_BUCKETS):
+        self._metrics[name] = (kind, help_text)
+        if kind == 'histogram':
+            self._buckets[name] = tuple(buckets)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            buckets = self._buckets.get(name, DURATION_BUCKETS)
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(buckets) + 2)
+            histogram[bisect_left(buckets, value)] += 1
+            histogram[-1] += value
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, list(value)) for key, value in self._histograms.items())
+
+        lines = []
+        described = set()
+
+        def header(name):
+            if name not in described and name in self._metrics:
+                kind, help_text = self._metrics[name]
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s %s' % (name, kind))
+            described.add(name)
+
+        for (name, labels), value in counters:
+            header(name)
+            lines.append('%s%s %s' % (name, _labels(labels), _number(value)))
+        for (name, labels), histogram in histograms:
+            header(name)
+            cumulative = 0
+            for bound, count in zip(self._buckets.get(name, DURATION_BUCKETS) + ('+Inf', ), histogram):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (name, _labels(labels + (('le', bound), )), cumulative))
+            lines.append('%s_sum%s %s' % (name, _labels(labels), _number(histogram[-1])))
+            lines.append('%s_count%s %d' % (name, _labels(labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                            .replace('\n', '\\n'))
+                             for key, value in labels)
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = MetricsRegistry()
+registry.describe('jobs_export_stage_seconds', 'histogram',
+                  'Seconds spent per export stage (admission, connect, query, fetch, write, attachments, smtp)',
+                  buckets=(0.005, 0.01, 0.05) + DURATION_BUCKETS)
+registry.describe('jobs_export_rows_total', 'counter', 'Rows exported')
+registry.describe('jobs_export_bytes_total', 'counter', 'Bytes of export files written')
+registry.describe('jobs_export_script_errors_total', 'counter', 'Scripts that failed to export')
+registry.describe('jobs_export_cache_hits_total', 'counter', 'Scripts served from the result cache')
+
+
+class RunMetrics(object):
+    """
+    Stage timings and counts of one export run, per script and for the run as a whole.
+    ``as_dict()`` is what the job returns, stored as the execution's metrics; every
+    value is also published to the registry labelled with the job name.
+    """
+
+    def __init__(self, job_name, registry=registry):
+        self.job_name = job_name
+        self.registry = registry
+        self.stages = {}  # stage -> seconds, whole run
+        self.scripts = {}  # script -> {stage_seconds / count: value}
+        self._lock = Lock()
+
+    @contextmanager
+    def stage(self, stage, script=None):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(stage, time.perf_counter() - started, script)
+
+    def add_stage(self, stage, seconds, script=None):
+        with self._lock:
+            target = self.stages if script is None else self.scripts.setdefault(script, {})
+            key = stage if script is None else '%s_seconds' % stage
+            target[key] = target.get(key, 0) + seconds
+        self.registry.observe('jobs_export_stage_seconds', seconds, job=self.job_name, stage=stage)
+
+    def count(self, name, value, script):
+        with self._lock:
+            counts = self.scripts.setdefault(script, {})
+            counts[name] = counts.get(name, 0) + value
+        if name in ('rows', 'bytes', 'script_errors', 'cache_hits'):
+            self.registry.inc('jobs_export_%s_total' % name, value, job=self.job_name)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'stages': {stage: round(seconds, 6) for stage, seconds in self.stages.items()},
+                'scripts': {script: {key: round(value, 6) if isinstance(value, float) else value
+                                     for key, value in values.items()}
+                            for script, values in self.scripts.items()},
+            }
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsServer(object):
+    """
+    Serves ``registry`` over HTTP from the scheduler process, where the jobs run.
+    The web process' metrics view reads it from there.
+    """
+
+    def __init__(self, address, registry=registry):
+        self.address = tuple(address)
+        self.registry = registry
+        self._server = None
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                LOGGER.debug(format, *args)
+
+        self._server = _ThreadingHTTPServer(self.address, Handler)
+        Thread(target=self._server.serve_forever, name='metrics-server', daemon=True).start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -1,4 +1,5 @@
 import os
+from django.core.exceptions import ValidationError
 from django.db import models
 from django.contrib.auth.models import User
 from django.utils import timezone
@@ -8,9 +9,14 @@ from django.utils.safestring import mark_safe
 
 class DjangoJob(models.Model):
     name = models.CharField('任务名称', max_length=255, unique=True)  # id of job
-    next_run_time = models.DateTimeField('执行时间', db_index=True)
+    next_run_time = models.DateTimeField('执行时间', db_index=True, null=True)  # null when paused
     # Perhaps consider using PickleField down the track.
     job_state = models.BinaryField()
+    # Bumped on every write so job stores can tell which cached jobs are stale
+    version = models.PositiveIntegerField('版本', default=0)
+    # Set while a scheduler node is submitting the job, see DjangoJobStore(lease_seconds=...)
+    lease_owner = models.CharField('执行节点', max_length=100, null=True, blank=True)
+    lease_expires = models.DateTimeField('租约到期', null=True, blank=True)
 
     def __str__(self):
         status = '执行时间: %s' % self.next_run_time if self.next_run_time else '暂停'
@@ -49,6 +55,8 @@ class DjangoJobExecution(models.Model):
 
     exception = models.CharField('错误描述', max_length=1000, null=True)
     traceback = models.TextField('错误回溯', null=True)
+    # JSON of the job's return value when it is a dict, stage timings of export jobs
+    metrics = models.TextField('运行指标', null=True, blank=True)
 
     def html_status(self):
         m = {
@@ -77,22 +85,40 @@ class DjangoJobExecution(models.Model):
         ordering = ('-run_time', )
         verbose_name = '记录'
         verbose_name_plural = '执行记录'
+        # One execution per run, result storages write by (job, run_time)
+        unique_together = ('job', 'run_time')
+        # Match the admin filters and the retention purge
+        indexes = [
+            models.Index(fields=['job', 'status', 'run_time']),
+            models.Index(fields=['status', 'run_time']),
+        ]
 
 
 class EmailJob(models.Model):
 
     TRIGGER_TYPE = (
         ('date', '时间类型(仅执行一次)'),
-        # ('interval', '循环类型(指定时间间隔周期执行)'),
+        ('interval', '循环类型(指定时间间隔周期执行)'),
         ('cron', 'cron风格(周期性执行)')
     )
+    EXPORT_FORMAT = (
+        ('xls', 'Excel 97-2003 (xls)'),
+        ('xlsx', 'Excel (xlsx, 流式写入)'),
+        ('csv', 'CSV'),
+        ('csv.gz', 'CSV (gzip压缩)'),
+        ('jsonl', 'JSON Lines'),
+        ('parquet', 'Parquet (需要pyarrow)'),
+    )
     name = models.CharField('任务名称', max_length=255, unique=True)  # id of job
     # next_run_time = models.DateTimeField('执行时间', db_index=True)
     created_date = models.DateTimeField('创建时间', default=timezone.now)
     #Trigger
-    trigger_type = models.CharField('触发类型', max_length=10, choices=TRIGGER_TYPE)
+    trigger_type = models.CharField('触发类型', max_length=10, choices=TRIGGER_TYPE, default='cron')
     trigger_value = models.CharField('触发参数', max_length=100, null=True, blank=True, help_text="""
-        <strong>cron风格(周期性执行)参数:</strong><br/>
+        JSON对象, 例如 {"day_of_week": "mon-fri", "hour": 8, "minute": 30}<br/>
+        <strong>时间类型(仅执行一次)参数:</strong> run_date (str) – 执行时间, 也可直接填写 2020-01-01 08:00:00<br/>
+        <strong>循环类型(指定时间间隔周期执行)参数:</strong> weeks, days, hours, minutes, seconds (int), start_date, end_date (str)<br/>
+        <strong>cron风格(周期性执行)参数:</strong> 也可直接填写crontab表达式, 例如 30 8 * * mon-fri<br/>
         &nbsp;&nbsp;&nbsp;&nbsp; year (int|str) – 4-digit year<br/>
         &nbsp;&nbsp;&nbsp;&nbsp; month (int|str) – month (1-12)<br/>
         &nbsp;&nbsp;&nbsp;&nbsp; day (int|str) – day of the (1-31)<br/>
@@ -103,7 +129,30 @@ class EmailJob(models.Model):
         &nbsp;&nbsp;&nbsp;&nbsp; second (int|str) – second (0-59)<br/>
     """)
     #DB
-    conn_str = models.CharField('目标数据库连接', max_length=100)
+    conn_str = models.CharField('目标数据库连接', max_length=255, blank=True, help_text="""
+        oracle://用户:密码@主机:端口/服务名 (或 用户/密码@主机:端口/服务名)<br/>
+        postgresql://用户:密码@主机:端口/数据库<br/>
+        sqlite:///相对路径 (相对于项目目录), sqlite:////绝对路径<br/>
+        django:别名 (settings.DATABASES中的连接), 为空时使用django:default<br/>
+    """)
+    concurrency = models.PositiveSmallIntegerField('脚本并发数', default=1,
+                                                   help_text='同时执行的脚本数量, 每个并发使用独立的数据库连接')
+    #Misfire
+    misfire_grace_time = models.PositiveIntegerField('错过执行宽限时间(秒)', default=600,
+                                                     help_text='调度器停机或繁忙错过执行时间后, 超过此时间的执行将被跳过, 0表示总是补执行')
+    coalesce = models.BooleanField('合并错过的执行', default=True,
+                                   help_text='错过多次执行时只补执行一次')
+    max_instances = models.PositiveSmallIntegerField('最大同时运行数', default=1,
+                                                     help_text='上一次执行未结束时允许同时运行的次数')
+    #Export
+    export_format = models.CharField('导出格式', max_length=10, choices=EXPORT_FORMAT, default='xls',
+                                     help_text='xls在内存中生成整个文件, 行数多时请使用xlsx或csv')
+    export_max_rows = models.PositiveIntegerField('单个工作表/文件最大行数', default=0,
+                                                  help_text='超过后拆分到新的工作表或文件, 0表示使用格式上限')
+    cache_ttl = models.PositiveIntegerField('结果缓存时间(秒)', default=0,
+                                            help_text='相同脚本和目标数据库在此时间内复用已导出的文件, 0表示不缓存')
+    render_process = models.BooleanField('独立进程生成文件', default=False,
+                                         help_text='在独立的进程中生成导出文件, 适合行数多的xls/xlsx, 进程配置见JOBS_RENDER')
     #Email
     smtp_server = models.CharField('发送邮件服务器(SMTP)', default='smtp.cq.sgcc.com.cn', max_length=50)
     # smtp_ssl = models.BooleanField('发送邮件服务器是否加密(SSL)', default = False)
@@ -113,9 +162,27 @@ class EmailJob(models.Model):
     subject = models.CharField('发送邮件主题', max_length=200)
     content = models.TextField('发送邮件内容', max_length=500 , null=True, blank=True)
     to_email = models.CharField('接收人邮件地址', max_length=250)
+    zip_attachments = models.BooleanField('附件打包为zip', default=False)
+    attachment_link_size = models.PositiveIntegerField('附件大小上限(MB)', default=0,
+                                                       help_text='超过后不再作为附件发送, 改为在邮件正文中发送下载链接, 0表示不限制')
 
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='users')
 
+    def get_trigger(self, timezone=None):
+        """
+        :return: the APScheduler trigger of ``trigger_type`` and ``trigger_value``, see jobs.triggers
+        :raises ValueError: if the trigger parameters are invalid
+        """
+        from .triggers import compile_trigger
+
+        return compile_trigger(self.trigger_type or 'cron', self.trigger_value, timezone)
+
+    def clean(self):
+        try:
+            self.get_trigger()
+        except ValueError as e:
+            raise ValidationError({'trigger_value': '触发参数无效: %s' % e})
+
     def user_name_property(self):
         return '%s(%s)' % (self.user.get_full_name(), self.user.username)
     user_name_property.short_description = '创建人'
@@ -134,10 +201,101 @@ class EmailJob(models.Model):
 class ScriptFile(models.Model):
     script_file = models.FileField('数据库脚本', upload_to='scripts/%Y%m%d%H%M%S/')
     email_job = models.ForeignKey(EmailJob, on_delete=models.CASCADE, related_name='script_files')
+    #Incremental
+    watermark_column = models.CharField('增量字段', max_length=100, blank=True,
+                                        help_text='设置后只导出该字段大于上次水位的数据, 邮件发送成功后水位前移')
+    watermark_value = models.CharField('上次水位', max_length=100, blank=True,
+                                       help_text='为空时导出全部数据')
+    append_to_file = models.BooleanField('追加到累计文件', default=False,
+                                         help_text='仅CSV格式: 新数据追加到累计文件, 发送累计文件')
 
     class Meta:
         verbose_name = '执行脚本'
         verbose_name_plural = '执行脚本'
 
     def __str__(self):
-        return os.path.split(str(self.script_file))[-1]
\ No newline at end of file
+        return os.path.split(str(self.script_file))[-1]
+
+
+class DjangoJobStats(models.Model):
+    """
+    Hourly rollup of a job's executions, maintained by jobs.stats.record_executions
+    as results are stored. Durations only cover successful runs.
+    """
+    job = models.ForeignKey(DjangoJob, verbose_name='任务', on_delete=models.CASCADE, related_name='stats')
+    period = models.DateTimeField('统计时段')
+    count = models.PositiveIntegerField('执行次数', default=0)
+    success_count = models.PositiveIntegerField('成功次数', default=0)
+    error_count = models.PositiveIntegerField('失败次数', default=0)
+    total_duration = models.FloatField('总时长', default=0)
+    max_duration = models.FloatField('最大时长', default=0)
+    # JSON list of counts per jobs.stats.DURATION_BUCKETS bucket
+    histogram = models.TextField('时长分布', default='[]')
+
+    class Meta:
+        unique_together = ('job', 'period')
+        ordering = ('-period', )
+        verbose_name = '执行统计'
+        verbose_name_plural = '执行统计'
+
+
+class RetentionPolicy(models.Model):
+    """
+    How long executions are kept. The most specific policy for an execution's job and
+    status applies, settings.JOBS_EXECUTION_RETENTION is the fallback.
+    """
+    DELETE = 'delete'
+    ARCHIVE = 'archive'
+
+    job = models.ForeignKey(DjangoJob, verbose_name='任务', on_delete=models.CASCADE,
+                            null=True, blank=True, help_text='为空表示所有任务')
+    status = models.CharField('状态', max_length=50, blank=True, help_text='为空表示所有状态', choices=[
+        [x, x] for x in [DjangoJobExecution.SENT, DjangoJobExecution.MAX_INSTANCES,
+                         DjangoJobExecution.MISSED, DjangoJobExecution.ERROR, DjangoJobExecution.SUCCESS]
+    ])
+    keep_days = models.PositiveIntegerField('保留天数')
+    action = models.CharField('过期处理', max_length=10, default=ARCHIVE, choices=[
+        (DELETE, '删除'),
+        (ARCHIVE, '压缩归档'),
+    ])
+
+    class Meta:
+        unique_together = ('job', 'status')
+        # unique_together doesn't hold for a NULL job, policies for all jobs need their own
+        constraints = [
+            models.UniqueConstraint(fields=['status'], condition=models.Q(job__isnull=True),
+                                    name='jobs_retentionpolicy_all_jobs_status'),
+        ]
+        verbose_name = '保留策略'
+        verbose_name_plural = '保留策略'
+
+    def __str__(self):
+        return '%s / %s: %d天' % (self.job or '所有任务', self.status or '所有状态', self.keep_days)
+
+    def validate_unique(self, exclude=None):
+        super(RetentionPolicy, self).validate_unique(exclude)
+        if self.job_id is None and RetentionPolicy.objects.filter(
+            job__isnull=True, status=self.status
+        ).exclude(pk=self.pk).exists():
+            raise ValidationError({'status': '所有任务的该状态已有保留策略'})
+
+
+class DjangoJobExecutionArchive(models.Model):
+    """
+    Executions moved out of DjangoJobExecution by the retention purge,
+    the traceback is zlib compressed.
+    """
+    job_name = models.CharField('任务名称', max_length=255, db_index=True)
+    status = models.CharField('状态', max_length=50)
+    run_time = models.DateTimeField('运行时间', db_index=True)
+    duration = models.DecimalField('平均时长', max_digits=15, decimal_places=2, null=True)
+    started = models.DecimalField('开始时间', max_digits=15, decimal_places=2, null=True)
+    finished = models.DecimalField('结束时间', max_digits=15, decimal_places=2, null=True)
+    exception = models.CharField('错误描述', max_length=1000, null=True)
+    traceback = models.BinaryField('错误回溯', null=True)
+    archived = models.DateTimeField('归档时间', default=timezone.now)
+
+    class Meta:
+        ordering = ('-run_time', )
+        verbose_name = '归档记录'
+        verbose_name_plural = '归档记录'
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from threading import Event
+
+from apscheduler.executors.asyncio import AsyncIOExecutor
+from apscheduler.executors.base import run_coroutine_job
+from django.conf import settings
+from django.db import connections
+
+from . import jobs
+from .admission import admission, scheduled_time
+from .db_pool import db_pools
+from .exporters import FETCH_SIZE, WRITERS
+from .metrics import RunMetrics
+from .render import render_pool, spool_cursor
+from .models import EmailJob
+
+LOGGER = logging.getLogger("jobs.pipeline")
+
+
+class ExportPipeline(object):
+    """
+    Runs exports as asyncio tasks. Blocking work happens in two bounded thread pools,
+    one for the database (queries, fetches, ORM) and one for writing files, and the
+    fetch and write stages of a script are connected by a queue of ``queue_size``
+    batches, so a slow writer holds back its fetcher instead of buffering rows.
+    A script is connected to, executed and fetched by a single fetch thread, as
+    Django connections and some drivers' cursors belong to the thread that opened them.
+    Emails go through the mail queue as before, awaited as futures.
+    :param int fetch_threads: threads running database calls
+    :param int write_threads: threads writing export files
+    :param int queue_size: fetched batches waiting to be written, per script
+    :param int max_runs: report runs in flight, more wait for a slot
+    """
+
+    def __init__(self, fetch_threads=32, write_threads=4, queue_size=4, max_runs=500):
+        self.queue_size = queue_size
+        self.max_runs = max_runs
+        self._fetch_pool = ThreadPoolExecutor(fetch_threads, thread_name_prefix='pipeline-fetch')
+        self._write_pool = ThreadPoolExecutor(write_threads, thread_name_prefix='pipeline-write')
+        self._runs = None
+
+    async def fetch(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._fetch_pool, func, *args)
+
+    async def write(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._write_pool, func, *args)
+
+    async def run_export(self, job):
+        """
+        The asyncio version of ``jobs.jobs.exp_oracle_script_job``.
+        """
+        if self._runs is None:
+            self._runs = asyncio.Semaphore(self.max_runs)
+        async with self._runs:
+            return await self._run_export(job)
+
+    async def _run_export(self, job):
+        if not isinstance(job, EmailJob):
+            job = await self.fetch(_orm, lambda: EmailJob.objects.get(pk=job))
+        metrics = RunMetrics(job.name)
+
+        f_stamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        exp_dir = os.path.join(settings.JOBS_EXPORT_ROOT, f_stamp)
+        os.makedirs(exp_dir, exist_ok=True)
+
+        exp_files = []
+        increments = []
+        try:
+            files = await self.fetch(_orm, lambda: list(job.script_files.all()))
+            # Scripts of one run keep the job's concurrency, the pipeline overlaps runs
+            slots = asyncio.Semaphore(max(job.concurrency, 1))
+
+            async def export(script_file):
+                async with slots:
+                    return await self._export_script(job, script_file, exp_dir, metrics)
+
+            admitting = time.perf_counter()
+            async with admission.admit_async(job.conn_str):
+                metrics.add_stage('admission', time.perf_counter() - admitting)
+                # Gathered in script order so the attachments keep a stable order
+                for paths, increment in await asyncio.gather(*[export(f) for f in files]):
+                    exp_files.extend(paths)
+                    if increment is not None:
+                        increments.append(increment)
+        except (Exception) as e:
+            LOGGER.exception('The DB Conn Error: %s' % e)
+        else:
+            sent = await self.write(jobs._send_report, job, f_stamp, exp_dir, exp_files, increments, metrics)
+            try:
+                await asyncio.wrap_future(sent)
+            except Exception:
+                pass  # logged by the mail queue, watermarks stay where they were
+        return metrics.as_dict()
+
+    async def _export_script(self, job, script_file, exp_dir, metrics):
+        """
+        ``jobs.jobs._exp_script`` as pipeline stages.
+        """
+        f_name = jobs._script_name(script_file)
+        try:
+            sql, cache_key, paths = await self.fetch(jobs._read_script, job, script_file, exp_dir, metrics)
+            if paths is not None:
+                return paths, None
+
+            timings = {}
+            stream = self._render if job.render_process else self._stream
+            paths, rows, cursor = await stream(job, sql, script_file, metrics,
+                                               os.path.join(exp_dir, f_name), timings)
+            return await self.write(jobs._finish_script, job, script_file, exp_dir, paths, rows,
+                                    timings, metrics, cursor, cache_key)
+        except (Exception) as e:
+            LOGGER.exception('The Script [%s] Error: %s' % (f_name, e))
+            metrics.count('script_errors', 1, f_name)
+            return [], None
+
+    @staticmethod
+    def _query(job, sql, script_file, metrics, consume):
+        """
+        Connects, executes the script and hands the cursor to ``consume``, all on the
+        calling fetch thread.
+        :return: (cursor, result of consume)
+        """
+        connecting = time.perf_counter()
+        with db_pools.connection(job.conn_str) as (target, conn):
+            metrics.add_stage('connect', time.perf_counter() - connecting, jobs._script_name(script_file))
+            cursor = jobs._execute_script(target, conn, sql, script_file, metrics)
+            try:
+                return cursor, consume(cursor)
+            finally:
+                cursor.close()
+
+    async def _stream(self, job, sql, script_file, metrics, path_base, timings):
+        """
+        ``jobs.exporters.export_cursor`` with the fetch and write stages running
+        concurrently, a bounded queue between them.
+        :return: (list of written file paths, row count, cursor)
+        """
+        loop = asyncio.get_running_loop()
+        batches = asyncio.Queue(self.queue_size)
+        stopped = Event()
+        timings.update(fetch=0, write=0)
+
+        def put(item):
+            # Waits for room in the queue
+            asyncio.run_coroutine_threadsafe(batches.put(item), loop).result()
+
+        def produce(cursor):
+            # Runs on the fetch thread that executed the query
+            headers = rows = None
+            while rows != [] and not stopped.is_set():
+                started = time.perf_counter()
+                rows = list(cursor.fetchmany(FETCH_SIZE))
+                timings['fetch'] += time.perf_counter() - started
+                if headers is None:
+                    # Server side cursors only describe the result after the first fetch
+                    headers = [field[0] for field in cursor.description]
+                    put(headers)
+                put(rows)
+
+        # Before the fetch starts: a writer that can't be built would leave it blocked on the queue
+        writer = WRITERS[job.export_format](path_base, job.export_max_rows)
+        fetching = loop.run_in_executor(self._fetch_pool, self._query, job, sql, script_file, metrics, produce)
+
+        async def get():
+            # Queued batches first, the query's error once there are none left
+            if batches.empty() and not fetching.done():
+                getting = asyncio.ensure_future(batches.get())
+                await asyncio.wait((getting, fetching), return_when=asyncio.FIRST_COMPLETED)
+                if getting.done():
+                    return getting.result()
+                getting.cancel()
+            if not batches.empty():
+                return batches.get_nowait()
+            fetching.result()
+            return []
+
+        async def write(func, *args):
+            started = time.perf_counter()
+            result = await self.write(func, *args)
+            timings['write'] += time.perf_counter() - started
+            return result
+
+        try:
+            headers = await get()
+            await write(writer.open, headers)
+            try:
+                rows = await get()
+                while rows:
+                    await write(writer.write_rows, rows)
+                    rows = await get()
+            finally:
+                paths = await write(writer.close)
+        finally:
+            # A fetcher waiting for room sees the stop once its put goes through
+            stopped.set()
+            while not batches.empty():
+                batches.get_nowait()
+            cursor, _ = await fetching
+        return paths, writer.rows, cursor
+
+    async def _render(self, job, sql, script_file, metrics, path_base, timings):
+        """
+        ``jobs.render.render_cursor``, the spool is written on a fetch thread and
+        the render awaited without holding one.
+        :return: (list of written file paths, row count, cursor)
+        """
+        spool = path_base + '.spool'
+
+        def consume(cursor):
+            started = time.perf_counter()
+            spool_cursor(cursor, spool)
+            timings['fetch'] = time.perf_counter() - started
+
+        try:
+            cursor, _ = await self.fetch(self._query, job, sql, script_file, metrics, consume)
+            rendering = time.perf_counter()
+            paths, rows = await asyncio.wrap_future(
+                render_pool.submit(spool, path_base, job.export_format, job.export_max_rows))
+            timings['write'] = time.perf_counter() - rendering
+        finally:
+            if os.path.exists(spool):
+                os.remove(spool)
+        return paths, rows, cursor
+
+    def shutdown(self):
+        self._fetch_pool.shutdown(wait=True)
+        self._write_pool.shutdown(wait=True)
+
+
+def _orm(func, *args):
+    # Django connections are per thread, pool threads close theirs after each call
+    try:
+        return func(*args)
+    finally:
+        connections["default"].close()
+
+
+class _AsyncVariant(object):
+    """
+    A job whose function is swapped for its coroutine version.
+    """
+
+    def __init__(self, job, func):
+        self._job = job
+        self.func = func
+
+    def __getattr__(self, name):
+        return getattr(self._job, name)
+
+
+class PipelineExecutor(AsyncIOExecutor):
+    """
+    AsyncIOExecutor that runs the jobs of ``exp_oracle_script_job`` through an
+    ExportPipeline. Stored jobs are unchanged, other functions run as usual.
+    """
+
+    def __init__(self, pipeline=None):
+        super(PipelineExecutor, self).__init__()
+        self.pipeline = pipeline or ExportPipeline(**settings.JOBS_ASYNC)
+        self.variants = {jobs.exp_oracle_script_job: self.pipeline.run_export}
+
+    def shutdown(self, wait=True):
+        super(PipelineExecutor, self).shutdown(wait)
+        self.pipeline.shutdown()
+
+    def _do_submit_job(self, job, run_times):
+        variant = self.variants.get(job.func)
+        if variant is None:
+            return super(PipelineExecutor, self)._do_submit_job(job, run_times)
+
+        def callback(f):
+            self._pending_futures.discard(f)
+            if f.cancelled():
+                return
+            try:
+                events = f.result()
+            except BaseException as e:
+                self._run_job_error(job.id, e, e.__traceback__)
+            else:
+                self._run_job_success(job.id, events)
+
+        coro = run_coroutine_job(_AsyncVariant(job, variant), job._jobstore_alias, run_times, self._logger.name)
+        # The task runs in a copy of the current context, see jobs.admission
+        token = scheduled_time.set(run_times[0])
+        try:
+            f = self._eventloop.create_task(coro)
+        finally:
+            scheduled_time.reset(token)
+        f.add_done_callback(callback)
+        self._pending_futures.add(f)
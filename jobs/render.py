@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import pickle
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+
+from django.conf import settings
+
+from .exporters import FETCH_SIZE, WRITERS, _read_lob
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+LOGGER = logging.getLogger("jobs.render")
+
+
+def spool_cursor(cursor, path, fetch_size=None):
+    """
+    Pickles the result of an executed cursor into ``path``: the column names,
+    then one list of rows per fetchmany() batch. LOBs are read on the way,
+    as their locators only live as long as the connection.
+    :return: number of rows spooled
+    """
+    fetch_size = fetch_size or FETCH_SIZE
+    rows_spooled = 0
+    lobs = None
+    with open(path, 'wb') as fp:
+        # Server side cursors only describe the result after the first fetch
+        rows = cursor.fetchmany(fetch_size)
+        pickle.dump([field[0] for field in cursor.description], fp, pickle.HIGHEST_PROTOCOL)
+        while rows:
+            if lobs is None:
+                lobs = {col for row in rows for col, value in enumerate(row) if hasattr(value, 'read')}
+            if lobs:
+                rows = [tuple(_read_lob(value) if col in lobs and value is not None else value
+                              for col, value in enumerate(row)) for row in rows]
+            pickle.dump(list(rows), fp, pickle.HIGHEST_PROTOCOL)
+            rows_spooled += len(rows)
+            rows = cursor.fetchmany(fetch_size)
+    return rows_spooled
+
+
+def render_spool(spool, path_base, export_format, max_rows):
+    """
+    Writes a spool of ``spool_cursor`` with the ``export_format`` writer, in a worker process.
+    :return: (list of written file paths, row count)
+    """
+    writer = WRITERS[export_format](path_base, max_rows)
+    with open(spool, 'rb') as fp:
+        writer.open(pickle.load(fp))
+        try:
+            while True:
+                try:
+                    rows = pickle.load(fp)
+                except EOFError:
+                    break
+                writer.write_rows(rows)
+        finally:
+            paths = writer.close()
+    return paths, writer.rows
+
+
+def _init_worker(memory_limit):
+    import django
+    django.setup()
+    if memory_limit and resource is not None:
+        limit = memory_limit * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+class RenderPool(object):
+    """
+    Worker processes writing export files, so the pure-Python writers don't hold
+    the scheduler process' GIL. Workers are spawned with the first render, limited
+    to ``memory_limit`` MB of address space where the platform allows it, and
+    replaced after ``max_tasks_per_child`` renders. A worker that dies takes the
+    renders in flight with it, the pool is rebuilt for the next ones.
+    :param int processes: worker processes
+    :param int max_tasks_per_child: renders before a worker is replaced, 0 keeps workers
+    :param int memory_limit: MB of address space per worker, 0 means no limit
+    """
+
+    def __init__(self, processes=2, max_tasks_per_child=20, memory_limit=1024):
+        self.processes = processes
+        self.max_tasks_per_child = max_tasks_per_child or None
+        self.memory_limit = memory_limit
+        self._executor = None
+        self._lock = Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # Forking a process with running threads can copy locks in a held state
+                self._executor = ProcessPoolExecutor(self.processes,
+                                                     mp_context=multiprocessing.get_context('spawn'),
+                                                     initializer=_init_worker,
+                                                     initargs=(self.memory_limit, ),
+                                                     max_tasks_per_child=self.max_tasks_per_child)
+            return self._executor
+
+    def _discard(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def submit(self, spool, path_base, export_format, max_rows):
+        """
+        :return: Future of render_spool's result
+        """
+        executor = self._get_executor()
+        try:
+            future = executor.submit(render_spool, spool, path_base, export_format, max_rows)
+        except BrokenProcessPool:
+            self._discard(executor)
+            executor = self._get_executor()
+            future = executor.submit(render_spool, spool, path_base, export_format, max_rows)
+
+        def check(f):
+            if not f.cancelled() and isinstance(f.exception(), BrokenProcessPool):
+                LOGGER.error('A render process died, restarting the render pool')
+                self._discard(executor)
+
+        future.add_done_callback(check)
+        return future
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+render_pool = RenderPool(**settings.JOBS_RENDER)
+
+
+def render_cursor(cursor, path_base, export_format='xls', max_rows=0, timings=None):
+    """
+    ``jobs.exporters.export_cursor`` with the files written by ``render_pool``:
+    the rows are spooled next to ``path_base`` and only the file paths come back.
+    """
+    spool = path_base + '.spool'
+    try:
+        tick = time.perf_counter()
+        spool_cursor(cursor, spool)
+        fetched = time.perf_counter()
+        paths, rows = render_pool.submit(spool, path_base, export_format, max_rows).result()
+        if timings is not None:
+            timings['fetch'] = timings.get('fetch', 0) + fetched - tick
+            timings['write'] = timings.get('write', 0) + time.perf_counter() - fetched
+    finally:
+        if os.path.exists(spool):
+            os.remove(spool)
+    LOGGER.info('Rendered %d rows to %s', rows, ', '.join(os.path.basename(p) for p in paths))
+    return paths, rows
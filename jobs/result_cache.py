@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+from threading import Lock
+
+from django.conf import settings
+
+LOGGER = logging.getLogger("jobs.result_cache")
+
+_META = 'meta.json'
+
+
+class ResultCache(object):
+    """
+    Rendered export files keyed by script content and connection target, so jobs that
+    attach the same SQL within the TTL reuse one export instead of querying again.
+    Entries are directories under ``root``, written to a temp directory and renamed.
+    Entries are shared by all jobs, so is the size limit.
+    :param str root: cache directory
+    :param int max_bytes: size above which least recently used entries are evicted
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+
+    @staticmethod
+    def key(sql, conn_str, *options):
+        digest = hashlib.sha256()
+        for part in (sql, conn_str) + options:
+            digest.update(str(part).encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def fetch(self, key, ttl, exp_dir, f_name):
+        """
+        Links (or copies) a fresh entry's files into ``exp_dir`` named after ``f_name``.
+        :return: list of file paths, None on a miss
+        """
+        entry = os.path.join(self.root, key)
+        try:
+            with open(os.path.join(entry, _META)) as fp:
+                meta = json.load(fp)
+        except (OSError, ValueError):
+            meta = None
+
+        if meta is None or time.time() - meta['created'] > ttl:
+            self._count(False, f_name)
+            return None
+
+        paths = []
+        try:
+            for suffix in meta['suffixes']:
+                path = os.path.join(exp_dir, f_name + suffix)
+                _link_or_copy(os.path.join(entry, suffix), path)
+                paths.append(path)
+            os.utime(os.path.join(entry, _META))  # recently used, evicted last
+        except OSError as e:
+            LOGGER.warning('Result cache entry %s unusable: %s', key, e)
+            self._count(False, f_name)
+            return None
+        self._count(True, f_name)
+        return paths
+
+    def store(self, key, paths, f_name):
+        """
+        Adds exported files under ``key``, then evicts least recently used entries
+        until the cache fits in ``max_bytes``.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=self.root, prefix='.tmp-')
+        try:
+            suffixes = []
+            for path in paths:
+                suffix = os.path.basename(path)[len(f_name):]
+                _link_or_copy(path, os.path.join(tmp, suffix))
+                suffixes.append(suffix)
+            with open(os.path.join(tmp, _META), 'w') as fp:
+                json.dump({'created': time.time(), 'suffixes': suffixes}, fp)
+
+            entry = os.path.join(self.root, key)
+            shutil.rmtree(entry, ignore_errors=True)
+            os.rename(tmp, entry)
+        except OSError as e:
+            LOGGER.warning('Unable to cache the export of [%s]: %s', f_name, e)
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.root):
+            entry = os.path.join(self.root, name)
+            if name.startswith('.') or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                used = os.path.getmtime(os.path.join(entry, _META))
+            except OSError:
+                continue
+            entries.append((used, size, entry))
+            total += size
+
+        for used, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def _count(self, hit, f_name):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            LOGGER.info('Result cache %s for [%s] (hits: %d, misses: %d)',
+                        'hit' if hit else 'miss', f_name, self.hits, self.misses)
+
+
+def _link_or_copy(src, dst):
+    # Exports are never modified in place, so a hard link is as good as a copy
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+result_cache = ResultCache(settings.JOBS_RESULT_CACHE_ROOT, settings.JOBS_RESULT_CACHE_MAX_SIZE * 1024 * 1024)
@@ -1,83 +1,385 @@
+import json
+import atexit
 import logging
 import time
+from collections import OrderedDict
+from operator import itemgetter
+from threading import Event, Lock, Thread
 
-from .models import DjangoJobExecution
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import ExpressionWrapper, F
+from django.db.models.functions import Coalesce
+
+from .models import DjangoJob, DjangoJobExecution
+from .stats import record_executions
 from .util import serialize_dt
 
+DURATION_FIELD = models.DecimalField(max_digits=15, decimal_places=2)
+
+# Keeps IN (...) lists below the SQLite host parameter limit
+QUERY_BATCH_SIZE = 500
+
 
 class DjangoResultStorage(object):
     """
     Uses Django ORM table for store job status and results.
     You can override this class to change result storage.
+    Every event is one statement in the common case: executions are unique on
+    (job, run_time), so the submission is a plain INSERT and the execution an UPDATE
+    of the changed fields; the other statement only runs when events come out of order.
     """
     LOGGER = logging.getLogger("result_storage")
 
-    def get_or_create_job_execution(self, job, event):
+    def __init__(self, started_timeout=86400):
+        # Submissions that never get an execution event (runs skipped as MAX_INSTANCES, a
+        # dead executor) are forgotten after started_timeout seconds
+        self.started_timeout = started_timeout
+        self._started_lock = Lock()
+        self._started = OrderedDict()  # (job pk, run_time) -> started, of runs submitted by this process
+
+    def get_or_create_job_execution(self, job_id, event):
         """
         Create and return new job execution item.
-        :param job: DjangoJob instance
+        :param job_id: DjangoJob primary key
         :param event: JobSubmissionEvent instance
-        :return: JobExecution id
+        :return: JobExecution id, None if the execution was already registered
         """
-        # type: (DjangoJob, JobSubmissionEvent)->int
+        # type: (int, JobSubmissionEvent)->int
+
+        run_time = serialize_dt(event.scheduled_run_times[0])
+        started = time.time()
+        with self._started_lock:
+            self._started[(job_id, run_time)] = started
+            _expire(self._started, started - self.started_timeout, float)
+        try:
+            with transaction.atomic():
+                return DjangoJobExecution.objects.create(
+                    job_id=job_id,
+                    status=DjangoJobExecution.SENT,
+                    started=started,
+                    run_time=run_time
+                ).id
+        except IntegrityError:
+            pass
 
         # For blocking schedulers we first got FINISH event, and than - SUBMITTED event
-        job_execution = DjangoJobExecution.objects.filter(
-            job=job,
-            run_time=serialize_dt(event.scheduled_run_times[0])
-        ).order_by("-id").first()
-
-        if job_execution and job_execution.started is None:
-            job_execution.started = time.time()
-            job_execution.duration = float(job_execution.finished) - float(job_execution.started)
-            job_execution.save()
-            return job_execution.id
-
-        return DjangoJobExecution.objects.create(
-            job=job,
-            status=DjangoJobExecution.SENT,
-            started=time.time(),
-            run_time=serialize_dt(event.scheduled_run_times[0])
-        ).id
-
-    def register_job_executed(self, job, event):
+        with self._started_lock:
+            self._started.pop((job_id, run_time), None)
+        DjangoJobExecution.objects.filter(
+            job_id=job_id,
+            run_time=run_time,
+            started__isnull=True
+        ).update(
+            started=started,
+            duration=ExpressionWrapper(F('finished') - started, output_field=DURATION_FIELD)
+        )
+
+    def register_job_executed(self, job_id, event):
         """
         Registration of job execution status
-        :param job: DjangoJob instance
+        :param job_id: DjangoJob primary key
         :param event: JobExecutionEvent instance
-        :return: JobExecution id
         """
-        # type: (DjangoJobExecution, JobExecutionEvent)->int
-
-        job_execution = DjangoJobExecution.objects.filter(
-            job=job,
-            status=DjangoJobExecution.SENT,
-            run_time=serialize_dt(event.scheduled_run_time)
-        ).order_by("id").last()  # type: DjangoJobExecution
-
-        if not job_execution:
-            job_execution = DjangoJobExecution.objects.create(
-                job=job,
-                status=DjangoJobExecution.SENT,
-                run_time=serialize_dt(event.scheduled_run_time)
-            )
-
-        if job_execution.finished:
-            self.LOGGER.warning("Job already finished! %s", job_execution)
+        # type: (int, JobExecutionEvent)->None
+
+        run_time = serialize_dt(event.scheduled_run_time)
+        finished = time.time()
+        with self._started_lock:
+            started = self._started.pop((job_id, run_time), None)
+        if started is not None:
+            duration = finished - started
+        else:
+            # Submitted before a restart, or not yet: the row knows
+            duration = Coalesce(ExpressionWrapper(finished - F('started'), output_field=DURATION_FIELD), 0)
+
+        fields = dict(finished=finished, duration=duration, status=DjangoJobExecution.SUCCESS,
+                      metrics=_metrics(event))
+        if event.exception:
+            fields.update(exception=str(event.exception)[:1000],
+                          traceback=str(event.traceback),
+                          status=DjangoJobExecution.ERROR)
+
+        updated = DjangoJobExecution.objects.filter(
+            job_id=job_id,
+            run_time=run_time,
+            finished__isnull=True
+        ).update(**fields)
+
+        if not updated:
+            if started is None:
+                fields['duration'] = 0
+            try:
+                with transaction.atomic():
+                    DjangoJobExecution.objects.create(job_id=job_id, run_time=run_time, **fields)
+            except IntegrityError:
+                self.LOGGER.warning("Job %s already finished at %s", job_id, run_time)
+                return
+
+        record_executions([(job_id, run_time, fields['status'],
+                            finished - started if started is not None else None)])
+
+    def close(self):
+        """
+        Called when the scheduler shuts down.
+        """
+
+
+def _expire(entries, deadline, added=itemgetter(-1)):
+    # ``entries`` is an OrderedDict in the order its entries were added
+    while entries:
+        key, entry = next(iter(entries.items()))
+        if added(entry) >= deadline:
             return
+        del entries[key]
 
-        job_execution.finished = time.time()
 
-        try:
-            job_execution.duration = float(job_execution.finished) - float(job_execution.started)
-        except:
-            job_execution.duration = 0
+def _metrics(event):
+    if not isinstance(event.retval, dict):
+        return None
+    try:
+        return json.dumps(event.retval, default=str)
+    except ValueError:
+        return None
 
-        job_execution.status = DjangoJobExecution.SUCCESS
 
-        if event.exception:
-            job_execution.exception = str(event.exception)
-            job_execution.traceback = str(event.traceback)
-            job_execution.status = DjangoJobExecution.ERROR
+class _PendingExecution(object):
+    __slots__ = ('job_id', 'run_time', 'pk', 'started', 'finished',
+                 'status', 'exception', 'traceback', 'metrics', 'attempts')
+
+    def __init__(self, job_id, run_time):
+        self.job_id = job_id
+        self.run_time = run_time
+        self.pk = None
+        self.started = None
+        self.finished = None
+        self.status = DjangoJobExecution.SENT
+        self.exception = None
+        self.traceback = None
+        self.metrics = None
+        self.attempts = 0
+
+    def merge(self, newer):
+        """
+        Takes over the events of ``newer``, a record of the same run queued after this one.
+        """
+        if self.started is None:
+            self.started = newer.started
+        if newer.finished is not None:
+            self.finished = newer.finished
+            self.status = newer.status
+            self.exception = newer.exception
+            self.traceback = newer.traceback
+            self.metrics = newer.metrics
+
+    @property
+    def duration(self):
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+
+class BufferedResultStorage(DjangoResultStorage):
+    """
+    Queues submission and execution events in memory and writes them from a background
+    thread. Both events of one run are merged into a single row, rows are written with
+    ``bulk_create``/``bulk_update``, once per ``flush_interval`` or as soon as ``batch_size``
+    events are pending. ``close()`` flushes whatever is left.
+    Events of jobs removed in the meantime are dropped. A batch that fails to write is
+    queued again and retried with the next flush, up to ``max_attempts`` times.
+    :param float flush_interval: seconds between flushes
+    :param int batch_size: pending runs that trigger an early flush
+    :param int max_attempts: writes of a run before its events are given up
+    :param float open_timeout: seconds a written, unfinished run is remembered; runs that
+        never finish are then looked up in the table again if they do
+    """
+
+    FIELDS = ('started', 'finished', 'duration', 'status', 'exception', 'traceback', 'metrics')
+
+    def __init__(self, flush_interval=1.0, batch_size=500, max_attempts=30, open_timeout=86400):
+        super(BufferedResultStorage, self).__init__()
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.open_timeout = open_timeout
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._pending = OrderedDict()  # (job pk, run_time) -> _PendingExecution
+        # (job pk, run_time) -> (pk, started, time written) of a written, unfinished row
+        self._open = OrderedDict()
+        self._wakeup = Event()
+        self._stopped = False
+        self._thread = Thread(target=self._run, name='result-storage-flusher', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def get_or_create_job_execution(self, job_id, event):
+        with self._lock:
+            record = self._pending_record(job_id, serialize_dt(event.scheduled_run_times[0]))
+            record.started = time.time()
+
+    def register_job_executed(self, job_id, event):
+        with self._lock:
+            record = self._pending_record(job_id, serialize_dt(event.scheduled_run_time))
+            if record.finished:
+                self.LOGGER.warning("Job %s already finished at %s", job_id, record.run_time)
+                return
+
+            record.finished = time.time()
+            record.status = DjangoJobExecution.SUCCESS
+            record.metrics = _metrics(event)
+            if event.exception:
+                record.exception = str(event.exception)[:1000]
+                record.traceback = str(event.traceback)
+                record.status = DjangoJobExecution.ERROR
+
+    def flush(self):
+        """
+        Writes all pending events.
+        """
+        with self._flush_lock:
+            with self._lock:
+                records = list(self._pending.values())
+                self._pending = OrderedDict()
+            if not records:
+                return
+            pks = [record.pk for record in records]
+            try:
+                self._write(self._live(records))
+            except Exception:
+                self.LOGGER.exception("Unable to store %d job executions, retrying", len(records))
+                # Ids found in the rolled back transaction may not exist
+                for record, pk in zip(records, pks):
+                    record.pk = pk
+                self._requeue(records)
+            finally:
+                connections["default"].close()
+
+    def close(self):
+        if self._stopped:
+            return
+        self._stopped = True
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+
+    def _requeue(self, records):
+        with self._lock:
+            pending = OrderedDict()
+            for record in records:
+                record.attempts += 1
+                if record.attempts >= self.max_attempts:
+                    self.LOGGER.error("Giving up the execution of job %s at %s after %d attempts",
+                                      record.job_id, record.run_time, record.attempts)
+                    continue
+                pending[(record.job_id, record.run_time)] = record
+            # Events that came in during the failed write belong to the same runs
+            for key, record in self._pending.items():
+                if key in pending:
+                    pending[key].merge(record)
+                else:
+                    pending[key] = record
+            self._pending = pending
+
+    def _live(self, records):
+        """
+        :return: the records whose job still exists; jobs with date triggers, for one,
+            are removed right after they are submitted
+        """
+        job_ids = list({record.job_id for record in records})
+        live = set()
+        for i in range(0, len(job_ids), QUERY_BATCH_SIZE):
+            live.update(DjangoJob.objects.filter(
+                pk__in=job_ids[i:i + QUERY_BATCH_SIZE]
+            ).values_list('pk', flat=True))
+        if len(live) < len(job_ids):
+            records = [record for record in records if record.job_id in live]
+            self.LOGGER.info("Dropped the executions of %d removed jobs", len(job_ids) - len(live))
+        return records
+
+    def _pending_record(self, job_id, run_time):
+        # Callers hold self._lock
+        key = (job_id, run_time)
+        record = self._pending.get(key)
+        if record is None:
+            record = self._pending[key] = _PendingExecution(job_id, run_time)
+            record.pk, record.started, _ = self._open.get(key, (None, None, None))
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+        return record
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def _write(self, records):
+        if not records:
+            return
+        with transaction.atomic():
+            new = [r for r in records if r.pk is None]
+            if new:
+                # Rows written before this process started (or by a previous batch
+                # whose ids were not returned) are matched instead of duplicated
+                self._match_open_rows(new)
+
+            existing = [r for r in records if r.pk is not None]
+            if existing:
+                DjangoJobExecution.objects.bulk_update(
+                    [self._to_model(r) for r in existing], self.FIELDS, batch_size=self.batch_size
+                )
+
+            created = [r for r in records if r.pk is None]
+            if created:
+                # A conflicting row is a run already stored by an earlier process
+                objs = DjangoJobExecution.objects.bulk_create(
+                    [self._to_model(r) for r in created], batch_size=self.batch_size,
+                    ignore_conflicts=True
+                )
+                for record, obj in zip(created, objs):
+                    record.pk = obj.pk
+                # Backends that don't return ids from bulk_create (SQLite)
+                self._match_open_rows([r for r in created if r.pk is None and r.finished is None])
+
+            record_executions((r.job_id, r.run_time, r.status, r.duration)
+                              for r in records if r.finished is not None)
+
+        with self._lock:
+            now = time.time()
+            for record in records:
+                key = (record.job_id, record.run_time)
+                self._open.pop(key, None)
+                if record.finished is None and record.pk is not None:
+                    self._open[key] = (record.pk, record.started, now)
+            _expire(self._open, now - self.open_timeout)
+
+    def _match_open_rows(self, records):
+        keys = {(r.job_id, r.run_time): r for r in records}
+        # Two IN lists per query, each half of QUERY_BATCH_SIZE
+        size = QUERY_BATCH_SIZE // 2
+        rows = (row for i in range(0, len(records), size) for row in DjangoJobExecution.objects.filter(
+            job_id__in={r.job_id for r in records[i:i + size]},
+            run_time__in={r.run_time for r in records[i:i + size]},
+            finished__isnull=True
+        ).order_by('id').values_list('id', 'job_id', 'run_time', 'started'))
+        for pk, job_id, run_time, started in rows:
+            record = keys.get((job_id, run_time))
+            if record is not None:
+                record.pk = pk
+                if record.started is None and started is not None:
+                    record.started = float(started)
 
-        job_execution.save()
+    @staticmethod
+    def _to_model(record):
+        return DjangoJobExecution(
+            id=record.pk,
+            job_id=record.job_id,
+            run_time=record.run_time,
+            started=record.started,
+            finished=record.finished,
+            duration=record.duration,
+            status=record.status,
+            exception=record.exception,
+            traceback=record.traceback,
+            metrics=record.metrics
+        )
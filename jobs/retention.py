@@ -0,0 +1,118 @@
+import zlib
+import logging
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
+
+from .models import DjangoJobExecution, DjangoJobExecutionArchive, RetentionPolicy
+
+LOGGER = logging.getLogger("jobs.retention")
+
+
+def _policies():
+    """
+    Configured policies plus the settings fallback, most specific first.
+    Only the fallback has an empty scope, no policy before it excludes everything.
+    """
+    default = settings.JOBS_EXECUTION_RETENTION
+    policies = list(RetentionPolicy.objects.select_related('job'))
+    # A policy for all jobs and statuses set in the admin replaces the settings
+    if not any(p.job_id is None and not p.status for p in policies):
+        policies.append(RetentionPolicy(keep_days=default['keep_days'], action=default['action']))
+    policies.sort(key=lambda p: (p.job_id is None, not p.status))
+    return policies
+
+
+def _scope(policy):
+    q = Q()
+    if policy.job_id is not None:
+        q &= Q(job_id=policy.job_id)
+    if policy.status:
+        q &= Q(status=policy.status)
+    return q
+
+
+def _overlaps(policy, other):
+    return ((policy.job_id is None or other.job_id is None or policy.job_id == other.job_id)
+            and (not policy.status or not other.status or policy.status == other.status))
+
+
+def purge_executions(batch_size=None, dry_run=False):
+    """
+    Deletes or archives executions older than their retention policy allows,
+    in transactions of at most ``batch_size`` rows.
+    :return: dict of action -> number of executions
+    """
+    batch_size = batch_size or settings.JOBS_EXECUTION_RETENTION['batch_size']
+    now = timezone.now() if settings.USE_TZ else datetime.now()
+    policies = _policies()
+    result = {RetentionPolicy.DELETE: 0, RetentionPolicy.ARCHIVE: 0}
+
+    for i, policy in enumerate(policies):
+        queryset = DjangoJobExecution.objects.filter(
+            _scope(policy), run_time__lt=now - timedelta(days=policy.keep_days)
+        )
+        # Executions a more specific policy applies to are left to that policy
+        for specific in policies[:i]:
+            if _overlaps(policy, specific):
+                queryset = queryset.exclude(_scope(specific))
+
+        if dry_run:
+            result[policy.action] += queryset.count()
+            continue
+
+        while True:
+            with transaction.atomic():
+                ids = list(queryset.order_by('id').values_list('id', flat=True)[:batch_size])
+                if not ids:
+                    break
+                if policy.action == RetentionPolicy.ARCHIVE:
+                    _archive(ids)
+                DjangoJobExecution.objects.filter(id__in=ids).delete()
+            result[policy.action] += len(ids)
+
+    LOGGER.info('Retention purge: %d deleted, %d archived%s', result[RetentionPolicy.DELETE],
+                result[RetentionPolicy.ARCHIVE], ' (dry run)' if dry_run else '')
+    return result
+
+
+def _archive(ids):
+    rows = DjangoJobExecution.objects.filter(id__in=ids).values_list(
+        'job__name', 'status', 'run_time', 'duration', 'started', 'finished', 'exception', 'traceback'
+    )
+    DjangoJobExecutionArchive.objects.bulk_create([
+        DjangoJobExecutionArchive(
+            job_name=job_name, status=status, run_time=run_time, duration=duration,
+            started=started, finished=finished, exception=exception,
+            traceback=zlib.compress(traceback.encode('utf-8')) if traceback else None
+        )
+        for job_name, status, run_time, duration, started, finished, exception, traceback in rows
+    ])
+
+
+def dedupe_executions(batch_size=None):
+    """
+    Deletes all but one execution of each (job, run_time), keeping the last finished one.
+    Earlier versions could record a run twice; run this before migrating to the unique
+    (job, run_time) of DjangoJobExecution.
+    :return: number of executions deleted
+    """
+    batch_size = batch_size or settings.JOBS_EXECUTION_RETENTION['batch_size']
+    duplicates = DjangoJobExecution.objects.order_by().values('job_id', 'run_time').annotate(
+        executions=Count('id')
+    ).filter(executions__gt=1)
+    surplus = []
+    for run in duplicates.iterator():
+        ids = DjangoJobExecution.objects.filter(job_id=run['job_id'], run_time=run['run_time']).order_by(
+            F('finished').desc(nulls_last=True), '-id'
+        ).values_list('id', flat=True)
+        surplus.extend(list(ids)[1:])
+
+    for i in range(0, len(surplus), batch_size):
+        with transaction.atomic():
+            DjangoJobExecution.objects.filter(id__in=surplus[i:i + batch_size]).delete()
+    LOGGER.info('Deleted %d duplicate executions', len(surplus))
+    return len(surplus)
@@ -0,0 +1,210 @@
+import pickle
+import zlib
+from datetime import datetime
+
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.date import DateTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class BaseSerializer(object):
+    """
+    Turns a job state (``Job.__getstate__()``) into the bytes stored in
+    ``DjangoJob.job_state`` and back.
+    Every format but plain pickle starts with a one byte ``tag``, so ``load_job_state``
+    can read rows written in any format.
+    """
+    tag = None
+
+    def dumps(self, job_state):
+        raise NotImplementedError
+
+    def loads(self, data):
+        raise NotImplementedError
+
+
+class PickleSerializer(BaseSerializer):
+    """
+    Plain pickle, the format DjangoJobStore always used.
+    Pickles of protocol 2 and later start with ``\\x80``.
+    """
+    tag = b'\x80'
+
+    def __init__(self, protocol=pickle.HIGHEST_PROTOCOL):
+        if 0 <= protocol < 2:
+            # Their pickles have no tag, load_job_state couldn't read them
+            raise ValueError('Pickle protocol %d is not supported, use 2 or later' % protocol)
+        self.protocol = protocol
+
+    def dumps(self, job_state):
+        return pickle.dumps(job_state, self.protocol)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class ZlibSerializer(PickleSerializer):
+    tag = b'Z'
+
+    def __init__(self, protocol=pickle.HIGHEST_PROTOCOL, level=6):
+        super(ZlibSerializer, self).__init__(protocol)
+        self.level = level
+
+    def dumps(self, job_state):
+        return self.tag + zlib.compress(super(ZlibSerializer, self).dumps(job_state), self.level)
+
+    def loads(self, data):
+        return super(ZlibSerializer, self).loads(zlib.decompress(data[1:]))
+
+
+class Lz4Serializer(PickleSerializer):
+    tag = b'L'
+
+    def __init__(self, protocol=pickle.HIGHEST_PROTOCOL):
+        if lz4 is None:
+            raise RuntimeError('lz4 is required for the lz4 job state format')
+        super(Lz4Serializer, self).__init__(protocol)
+
+    def dumps(self, job_state):
+        return self.tag + lz4.frame.compress(super(Lz4Serializer, self).dumps(job_state))
+
+    def loads(self, data):
+        return super(Lz4Serializer, self).loads(lz4.frame.decompress(data[1:]))
+
+
+class MsgpackSerializer(BaseSerializer):
+    """
+    Schema based format: the job state is packed as a msgpack array of its fields,
+    cron/interval/date triggers are reduced to their constructor arguments.
+    Other triggers, and args/kwargs msgpack can't represent, are embedded as pickles.
+    """
+    tag = b'M'
+
+    def __init__(self, protocol=pickle.HIGHEST_PROTOCOL):
+        if msgpack is None:
+            raise RuntimeError('msgpack is required for the msgpack job state format')
+        self.protocol = protocol
+
+    def dumps(self, job_state):
+        return self.tag + msgpack.packb([
+            job_state['version'],
+            job_state['id'],
+            job_state['func'],
+            self._dump_trigger(job_state['trigger']),
+            job_state['executor'],
+            self._dump_value(list(job_state['args'])),
+            self._dump_value(job_state['kwargs']),
+            job_state['name'],
+            job_state['misfire_grace_time'],
+            job_state['coalesce'],
+            job_state['max_instances'],
+            _dump_dt(job_state['next_run_time']),
+        ], use_bin_type=True)
+
+    def loads(self, data):
+        (version, job_id, func, trigger, executor, args, kwargs, name,
+         misfire_grace_time, coalesce, max_instances, next_run_time) = msgpack.unpackb(
+            data[1:], raw=False, strict_map_key=False)
+        trigger = self._load_trigger(trigger)
+        next_run_time = _load_dt(next_run_time)
+        return {
+            'version': version,
+            'id': job_id,
+            'func': func,
+            'trigger': trigger,
+            'executor': executor,
+            'args': tuple(self._load_value(args)),
+            'kwargs': self._load_value(kwargs),
+            'name': name,
+            'misfire_grace_time': misfire_grace_time,
+            'coalesce': coalesce,
+            'max_instances': max_instances,
+            'next_run_time': next_run_time.astimezone(trigger.timezone)
+            if next_run_time and hasattr(trigger, 'timezone') else next_run_time,
+        }
+
+    def _dump_value(self, value):
+        try:
+            return [0, msgpack.packb(value, use_bin_type=True)]
+        except TypeError:
+            return [1, pickle.dumps(value, self.protocol)]
+
+    def _load_value(self, value):
+        kind, data = value
+        if kind == 0:
+            return msgpack.unpackb(data, raw=False, strict_map_key=False)
+        return pickle.loads(data)
+
+    def _dump_trigger(self, trigger):
+        if type(trigger) is CronTrigger:
+            return ['cron', [str(field) for field in trigger.fields], str(trigger.timezone),
+                    _dump_dt(trigger.start_date), _dump_dt(trigger.end_date), trigger.jitter]
+        if type(trigger) is IntervalTrigger:
+            return ['interval', trigger.interval.total_seconds(), str(trigger.timezone),
+                    _dump_dt(trigger.start_date), _dump_dt(trigger.end_date), trigger.jitter]
+        if type(trigger) is DateTrigger:
+            return ['date', _dump_dt(trigger.run_date)]
+        return ['pickle', pickle.dumps(trigger, self.protocol)]
+
+    def _load_trigger(self, data):
+        kind = data[0]
+        if kind == 'cron':
+            _, fields, timezone, start_date, end_date, jitter = data
+            return CronTrigger(start_date=_load_dt(start_date), end_date=_load_dt(end_date),
+                               timezone=timezone, jitter=jitter,
+                               **dict(zip(CronTrigger.FIELD_NAMES, fields)))
+        if kind == 'interval':
+            _, seconds, timezone, start_date, end_date, jitter = data
+            return IntervalTrigger(seconds=seconds, start_date=_load_dt(start_date),
+                                   end_date=_load_dt(end_date), timezone=timezone, jitter=jitter)
+        if kind == 'date':
+            return DateTrigger(run_date=_load_dt(data[1]))
+        return pickle.loads(data[1])
+
+
+def _dump_dt(dt):
+    return dt.isoformat() if dt is not None else None
+
+
+def _load_dt(value):
+    return datetime.fromisoformat(value) if value is not None else None
+
+
+SERIALIZERS = {
+    'pickle': PickleSerializer,
+    'zlib': ZlibSerializer,
+    'lz4': Lz4Serializer,
+    'msgpack': MsgpackSerializer,
+}
+
+_LOADERS = {}
+
+
+def get_serializer(name, **kwargs):
+    return SERIALIZERS[name](**kwargs)
+
+
+def load_job_state(data):
+    """
+    Reads a job_state blob written by any of the ``SERIALIZERS``.
+    """
+    data = bytes(data)
+    tag = data[:1]
+    if tag not in _LOADERS:
+        for serializer_class in SERIALIZERS.values():
+            if serializer_class.tag == tag:
+                _LOADERS[tag] = serializer_class()
+                break
+        else:
+            raise ValueError('Unknown job state format %r' % tag)
+    return _LOADERS[tag].loads(data)
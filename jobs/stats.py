@@ -0,0 +1,132 @@
+import json
+from collections import defaultdict
+
+from django.db import transaction
+
+from .models import DjangoJobExecution, DjangoJobStats
+
+# Upper bounds (seconds) of the duration histogram buckets, the last bucket is open ended
+DURATION_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+class JobStats(object):
+    """
+    Execution statistics of one job, merged from any number of rollup rows.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.success_count = 0
+        self.error_count = 0
+        self.total_duration = 0.0
+        self.max_duration = 0.0
+        self.histogram = [0] * (len(DURATION_BUCKETS) + 1)
+
+    def add_execution(self, status, duration):
+        self.count += 1
+        if status == DjangoJobExecution.ERROR:
+            self.error_count += 1
+        elif status == DjangoJobExecution.SUCCESS:
+            self.success_count += 1
+            duration = float(duration or 0)
+            self.total_duration += duration
+            self.max_duration = max(self.max_duration, duration)
+            self.histogram[_bucket(duration)] += 1
+
+    def merge(self, row):
+        self.count += row.count
+        self.success_count += row.success_count
+        self.error_count += row.error_count
+        self.total_duration += row.total_duration
+        self.max_duration = max(self.max_duration, row.max_duration)
+        for i, n in enumerate(json.loads(row.histogram or '[]')):
+            self.histogram[i] += n
+
+    @property
+    def avg_duration(self):
+        return self.total_duration / self.success_count if self.success_count else 0
+
+    def percentile(self, q):
+        """
+        Approximate duration percentile, interpolated inside the histogram bucket.
+        """
+        total = sum(self.histogram)
+        if not total:
+            return 0
+        rank = q / 100.0 * total
+        seen = 0
+        for i, n in enumerate(self.histogram):
+            if n and seen + n >= rank:
+                low = DURATION_BUCKETS[i - 1] if i else 0
+                high = DURATION_BUCKETS[i] if i < len(DURATION_BUCKETS) else self.max_duration
+                return min(low + (high - low) * (rank - seen) / n, self.max_duration)
+            seen += n
+        return self.max_duration
+
+
+def _bucket(duration):
+    for i, bound in enumerate(DURATION_BUCKETS):
+        if duration <= bound:
+            return i
+    return len(DURATION_BUCKETS)
+
+
+def record_executions(executions):
+    """
+    Adds finished executions to the hourly rollup, one row update per job and hour.
+    :param executions: iterable of (job pk, run_time, status, duration)
+    """
+    groups = defaultdict(JobStats)
+    for job_id, run_time, status, duration in executions:
+        groups[(job_id, run_time.replace(minute=0, second=0, microsecond=0))].add_execution(status, duration)
+    if not groups:
+        return
+
+    with transaction.atomic():
+        for (job_id, period), stats in groups.items():
+            row, _ = DjangoJobStats.objects.select_for_update().get_or_create(job_id=job_id, period=period)
+            stats.merge(row)
+            row.count = stats.count
+            row.success_count = stats.success_count
+            row.error_count = stats.error_count
+            row.total_duration = stats.total_duration
+            row.max_duration = stats.max_duration
+            row.histogram = json.dumps(stats.histogram)
+            row.save()
+
+
+def rebuild_stats(since):
+    """
+    Recomputes the rollup from ``since`` on out of the stored executions, e.g. to fill
+    it in after a deploy. Purged and unfinished executions are not counted; rollup rows
+    written meanwhile by the scheduler are replaced, so run it while no jobs finish.
+    :return: number of rollup rows written
+    """
+    since = since.replace(minute=0, second=0, microsecond=0)
+    groups = defaultdict(JobStats)
+    executions = DjangoJobExecution.objects.filter(
+        run_time__gte=since, finished__isnull=False
+    ).values_list('job_id', 'run_time', 'status', 'duration')
+    for job_id, run_time, status, duration in executions.iterator():
+        groups[(job_id, run_time.replace(minute=0, second=0, microsecond=0))].add_execution(status, duration)
+
+    with transaction.atomic():
+        DjangoJobStats.objects.filter(period__gte=since).delete()
+        DjangoJobStats.objects.bulk_create([
+            DjangoJobStats(job_id=job_id, period=period, count=stats.count,
+                           success_count=stats.success_count, error_count=stats.error_count,
+                           total_duration=stats.total_duration, max_duration=stats.max_duration,
+                           histogram=json.dumps(stats.histogram))
+            for (job_id, period), stats in groups.items()
+        ], batch_size=500)
+    return len(groups)
+
+
+def job_stats(since):
+    """
+    :return: dict of job pk -> JobStats over the rollup rows from ``since`` on
+    """
+    result = defaultdict(JobStats)
+    for row in DjangoJobStats.objects.filter(period__gte=since):
+        result[row.job_id].merge(row)
+    return result
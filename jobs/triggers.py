@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import json
+from functools import lru_cache
+
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.date import DateTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+
+
+def _cron_trigger(value, timezone):
+    # A crontab line ("30 8 * * mon-fri") or CronTrigger keyword arguments
+    if isinstance(value, str):
+        return CronTrigger.from_crontab(value, timezone=timezone)
+    return CronTrigger(timezone=timezone, **value)
+
+
+def _date_trigger(value, timezone):
+    # A date string ("2020-01-01 08:00:00") or DateTrigger keyword arguments
+    if isinstance(value, str):
+        return DateTrigger(value, timezone=timezone)
+    return DateTrigger(timezone=timezone, **value)
+
+
+def _interval_trigger(value, timezone):
+    if not isinstance(value, dict):
+        raise ValueError('interval parameters must be a JSON object, e.g. {"hours": 1}')
+    return IntervalTrigger(timezone=timezone, **value)
+
+
+TRIGGER_BUILDERS = {
+    'cron': _cron_trigger,
+    'date': _date_trigger,
+    'interval': _interval_trigger,
+}
+
+
+def parse_trigger_value(trigger_value):
+    """
+    :return: the JSON value of ``trigger_value``, or the string itself if it isn't JSON
+    """
+    trigger_value = (trigger_value or '').strip()
+    if not trigger_value:
+        raise ValueError('trigger parameters are required')
+    if trigger_value[0] not in '{"':
+        return trigger_value
+    try:
+        value = json.loads(trigger_value)
+    except ValueError as e:
+        raise ValueError('invalid JSON: %s' % e)
+    if not isinstance(value, (dict, str)):
+        raise ValueError('trigger parameters must be a JSON object or a string')
+    return value
+
+
+# Arguments without which a trigger is anchored at the time it is built
+_ANCHORS = {
+    'date': 'run_date',
+    'interval': 'start_date',
+}
+
+
+def compile_trigger(trigger_type, trigger_value, timezone=None):
+    """
+    Builds the APScheduler trigger of an EmailJob. Triggers are immutable once built,
+    the same instance is shared by every job with the same parameters, except those
+    anchored at the time they are built (an interval without a start_date runs every
+    N hours from its activation on), which are built anew every time.
+    :param str trigger_type: one of TRIGGER_BUILDERS
+    :param str trigger_value: JSON object of the trigger's arguments, or the short form
+        of the trigger type (a crontab line, a date)
+    :param timezone: timezone of the trigger, the local timezone by default
+    :raises ValueError: if the type is unknown or the parameters are invalid
+    """
+    trigger, shared = _compile_trigger(trigger_type, trigger_value, timezone)
+    if not shared:
+        trigger, _ = _compile_trigger.__wrapped__(trigger_type, trigger_value, timezone)
+    return trigger
+
+
+@lru_cache(maxsize=4096)
+def _compile_trigger(trigger_type, trigger_value, timezone):
+    """
+    :return: (trigger, whether it may be shared)
+    """
+    try:
+        builder = TRIGGER_BUILDERS[trigger_type]
+    except KeyError:
+        raise ValueError('unknown trigger type %r' % trigger_type)
+    value = parse_trigger_value(trigger_value)
+    try:
+        trigger = builder(value, timezone)
+    except TypeError as e:
+        # Unexpected keyword arguments
+        raise ValueError(str(e))
+    anchor = _ANCHORS.get(trigger_type)
+    return trigger, anchor is None or not isinstance(value, dict) or bool(value.get(anchor))
@@ -1,4 +1,7 @@
+from urllib.parse import quote
+
 from django.conf import settings
+from django.core.signing import BadSignature, TimestampSigner
 from django.utils.timezone import is_aware, is_naive, make_aware, make_naive
 
 
@@ -8,12 +11,49 @@ def serialize_dt(dt):
     :param dt:
     :return:
     """
-    if not settings.USE_TZ and is_aware(dt):
+    if dt is not None and not settings.USE_TZ and is_aware(dt):
         return make_naive(dt)
     return dt
 
 
 def deserialize_dt(dt):
-    if not settings.USE_TZ and is_naive(dt):
+    if dt is not None and not settings.USE_TZ and is_naive(dt):
         return make_aware(dt)
     return dt
+
+
+def int_param(request, name, default, maximum):
+    """
+    Reads a positive integer query parameter, ``default`` when missing or invalid.
+    """
+    try:
+        value = int(request.GET.get(name, default))
+    except (TypeError, ValueError):
+        return default
+    return min(max(value, 1), maximum)
+
+
+_EXPORT_SIGNER = TimestampSigner(salt='jobs.export_file')
+
+
+def export_url(relative):
+    """
+    Absolute download URL of an exported file, with a token that lets recipients
+    without an account fetch it for JOBS_EXPORT_LINK_MAX_AGE seconds.
+    :param str relative: path of the file in JOBS_EXPORT_ROOT, '/' separated
+    """
+    # sign() returns "value:timestamp:signature", the token is what follows the value
+    token = _EXPORT_SIGNER.sign(relative)[len(relative) + 1:]
+    return '%s%s%s?token=%s' % (settings.JOBS_EXPORT_BASE_URL.rstrip('/'), settings.JOBS_EXPORT_URL,
+                                quote(relative), token)
+
+
+def check_export_token(relative, token):
+    """
+    :return: whether ``token`` is an unexpired token of ``export_url(relative)``
+    """
+    try:
+        _EXPORT_SIGNER.unsign('%s:%s' % (relative, token), max_age=settings.JOBS_EXPORT_LINK_MAX_AGE)
+    except BadSignature:
+        return False
+    return True
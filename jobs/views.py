@@ -1,3 +1,68 @@
-from django.shortcuts import render
+import os
+from urllib.request import urlopen
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.exceptions import PermissionDenied
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse
+from django.utils._os import safe_join
+
+from .control import shared_control
+from .forecast import hot_minutes
+from .metrics import CONTENT_TYPE
+from .util import check_export_token, int_param
 
 # Create your views here.
+
+
+def export_file(request, path):
+    """
+    Serves an exported report that was too large to attach to its email, to staff
+    and to holders of the link's token (see jobs.util.export_url).
+    """
+    if not (request.user.is_active and request.user.is_staff
+            or check_export_token(path, request.GET.get('token', ''))):
+        raise PermissionDenied
+    try:
+        full_path = safe_join(settings.JOBS_EXPORT_ROOT, path)
+    except ValueError:
+        raise Http404
+    if not os.path.isfile(full_path):
+        raise Http404
+    return FileResponse(open(full_path, 'rb'), as_attachment=True, filename=os.path.basename(full_path))
+
+
+def metrics(request):
+    """
+    Prometheus metrics of the job runs. They are collected in the scheduler process,
+    which serves them on JOBS_METRICS['address'], this view passes them on.
+    Served to staff, to scrapers sending JOBS_METRICS['token'] and to 'allowed_ips'
+    (none by default, see the settings).
+    """
+    options = settings.JOBS_METRICS
+    if not (request.user.is_active and request.user.is_staff
+            or options['token'] and request.META.get('HTTP_AUTHORIZATION') == 'Bearer %s' % options['token']
+            or request.META.get('REMOTE_ADDR') in options['allowed_ips']):
+        return HttpResponse('Unauthorized', status=401, content_type='text/plain')
+    try:
+        with urlopen('http://%s:%d/metrics' % tuple(options['address']), timeout=5) as response:
+            body = response.read()
+    except OSError as e:
+        return HttpResponse('Scheduler metrics unavailable: %s' % e, status=503, content_type='text/plain')
+    return HttpResponse(body, content_type=CONTENT_TYPE)
+
+
+@staff_member_required
+def forecast(request):
+    """
+    Next fire times of the scheduled jobs and the minutes in which most of them fire.
+    Query parameters: days (7), limit of fire times per job (10), top hot minutes (20).
+    """
+    limit = int_param(request, 'limit', 10, 1000)
+    fire_times = shared_control().forecast(int_param(request, 'days', 7, 31))
+    return JsonResponse({
+        'jobs': {job_id: [fire_time.isoformat() for fire_time in times[:limit]]
+                 for job_id, times in fire_times.items()},
+        'hot_minutes': [{'minute': minute.isoformat(), 'jobs': job_ids}
+                        for minute, job_ids in hot_minutes(fire_times, int_param(request, 'top', 20, 1000))],
+    })